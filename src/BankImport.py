@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+"""
+Turn bank or brokerage CSV statements into Transfers of a FinanceSystem.
+
+Each row of a statement is one Transfer between the statement's account Repo and
+a counterpart Repo.  A negative amount leaves the account, a positive one arrives.
+Rules match the row description and add tags (and may pick the counterpart).
+
+The statement is streamed one row at a time.  Every imported row is recorded by its
+hash in an ImportIndex kept in the DB directory, so importing overlapping statements
+again only adds the rows that are new.  Rules are read from <db>/import_rules.yaml.
+
+	./BankImport.py db/money statement.csv "Capital One Checking"
+"""
+
+import sys
+import csv
+import re
+import os
+import os.path
+import hashlib
+import yaml
+from decimal import Decimal, InvalidOperation
+from datetime import datetime
+from PlainTxtDB import DB
+from Money import Transfer, parse_when
+
+
+class ImportIndex(object):
+	""" The hashes of every row imported into a DB, stored as fixed-size records in an append-only file """
+	FILENAME = 'imported.idx'
+	SIZE = 16 # bytes of the sha1 kept per row
+
+	def __init__(self, path):
+		self.filename = os.path.join(path, ImportIndex.FILENAME)
+		self.hashes = set()
+		self.pending = []
+		if os.path.exists(self.filename):
+			with open(self.filename, 'rb') as f:
+				data = f.read()
+			n = len(data) // ImportIndex.SIZE # ignore a partially written last record
+			self.hashes = {data[i*ImportIndex.SIZE:(i+1)*ImportIndex.SIZE] for i in range(n)}
+
+	@staticmethod
+	def key(fields):
+		return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).digest()[:ImportIndex.SIZE]
+
+	def __contains__(self, key):
+		return key in self.hashes
+
+	def add(self, key):
+		self.hashes.add(key)
+		self.pending.append(key)
+
+	def commit(self):
+		""" Append the new hashes to the index file.  Do this after the DB is saved. """
+		if not self.pending:
+			return
+		with open(self.filename, 'ab') as f:
+			f.write(b''.join(self.pending))
+			f.flush()
+			os.fsync(f.fileno())
+		self.pending = []
+
+
+class ImportRule(object):
+	""" If \a pattern (a case-insensitive regular expression) is found in a row's description
+	then add \a tags to the Transfer and, if given, use the Repo named \a repo as the counterpart.
+	"""
+	def __init__(self, pattern, tags=(), repo=None):
+		self.pattern = re.compile(pattern, re.IGNORECASE)
+		self.tags = [t.strip().upper() for t in tags]
+		self.repo = repo
+
+	def match(self, description):
+		return self.pattern.search(description) is not None
+
+
+class StatementImporter(object):
+	"""
+	\param system: the FinanceSystem to add Transfers to
+	\param path: the DB directory (where the ImportIndex lives)
+	\param columns: the CSV header names for 'date', 'description', 'amount' and optionally 'account'
+	\param date_format: strptime format of the dates.  None means ISO 8601.
+	\param rules: a list of ImportRule
+	\param accounts: {account name in the statement: Repo name}.  By default they are the same.
+	\param other: the Repo name of the counterpart when no rule gives one
+	"""
+	COLUMNS = {'date': 'Date', 'description': 'Description', 'amount': 'Amount', 'account': 'Account'}
+
+	def __init__(self, system, path, columns=None, date_format=None, rules=(), accounts=None, other='External'):
+		self.system = system
+		self.index = ImportIndex(path)
+		self.columns = dict(StatementImporter.COLUMNS, **(columns or {}))
+		self.date_format = date_format
+		self.rules = list(rules)
+		self.accounts = accounts or {}
+		self.other = other
+		self.repos = {r.name: r for r in system.repos}
+
+	@staticmethod
+	def load_rules(filename):
+		""" Read a list of rules from a YAML file:  - {match: 'AMAZON|WALMART', tags: [shopping], repo: Stores} """
+		with open(filename, encoding='utf-8') as f:
+			return [ImportRule(r['match'], r.get('tags', ()), r.get('repo')) for r in yaml.safe_load(f) or []]
+
+	def repo(self, name):
+		if name not in self.repos:
+			raise Exception("There is no repo named '%s'"%name)
+		return self.repos[name]
+
+	def parse_date(self, text):
+		if self.date_format:
+			return datetime.strptime(text.strip(), self.date_format)
+		return parse_when(text)
+
+	@staticmethod
+	def parse_amount(text, frac_digits):
+		""" Turn '-1,234.56', '$12.00' or '(12.00)' into an exact integer number of the smallest unit """
+		text = text.strip().replace(',', '').replace('$', '')
+		negative = text.startswith('(') and text.endswith(')')
+		try:
+			amt = Decimal(text.strip('()')) * (10 ** frac_digits)
+		except InvalidOperation:
+			raise ValueError("'%s' is not an amount"%text)
+		if amt != amt.to_integral_value():
+			raise ValueError("'%s' has too many digits"%text)
+		return -int(amt) if negative else int(amt)
+
+	def rows(self, filename):
+		""" Stream the rows of \a filename as dicts """
+		with open(filename, newline='', encoding='utf-8-sig') as f:
+			for row in csv.DictReader(f):
+				yield row
+
+	def run(self, filename, account=None):
+		"""
+		Import the statement \a filename.  \a account names the statement's account
+		when the CSV has no account column.
+		Returns a report {'imported', 'skipped', 'errors'}.
+		"""
+		report = {'imported': 0, 'skipped': 0, 'errors': []}
+		col = self.columns
+		seen = {} # identical rows in one statement (two coffees on the same day) are told apart by their count
+		for line, row in enumerate(self.rows(filename), 2):
+			try:
+				name = row.get(col['account']) or account
+				if not name:
+					raise ValueError("No account for this row")
+				fields = [name, row[col['date']].strip(), row[col['amount']].strip(), row[col['description']].strip()]
+				row_key = ImportIndex.key(fields)
+				n = seen.get(row_key, 0)
+				seen[row_key] = n + 1
+				key = ImportIndex.key(fields + [str(n)])
+				if key in self.index:
+					report['skipped'] += 1
+					continue
+				self.system.add_transfer(self.transfer(self.repo(self.accounts.get(name, name)), row))
+				self.index.add(key)
+				report['imported'] += 1
+			except Exception as e:
+				report['errors'].append((line, str(e)))
+		print("Imported %d rows from %s (%d already imported, %d errors)"%(
+			report['imported'], filename, report['skipped'], len(report['errors'])))
+		return report
+
+	def transfer(self, repo, row):
+		""" Make the Transfer for one statement \a row of \a repo's account """
+		description = row[self.columns['description']].strip()
+		amt = StatementImporter.parse_amount(row[self.columns['amount']], repo.unit.frac_digits)
+		tags = []
+		other = self.other
+		for rule in self.rules:
+			if rule.match(description):
+				tags += [t for t in rule.tags if t not in tags]
+				other = rule.repo or other
+		other = self.repo(other)
+		if other.unit != repo.unit: # the amount is only in the account's unit
+			raise ValueError("%s is in %s, not %s like %s"%(other.name, other.unit, repo.unit, repo.name))
+		src, dst = (repo, other) if amt < 0 else (other, repo)
+		return Transfer(from_repo=src, from_amt=abs(amt), to_repo=dst, to_amt=abs(amt),
+			timestamp=self.parse_date(row[self.columns['date']]), memo=description, tags=tags)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print(__doc__)
+		sys.exit(1)
+	path, filename = sys.argv[1:3]
+	system, name = DB.load(path)
+	rules = os.path.join(path, 'import_rules.yaml')
+	importer = StatementImporter(system, path, rules=StatementImporter.load_rules(rules) if os.path.exists(rules) else ())
+	importer.run(filename, sys.argv[3] if len(sys.argv) > 3 else None)
+	DB.save(system, path, base=name)
+	importer.index.commit()
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+"""
+A small HTTP server that answers JSON queries about a food DB (and optionally a finance DB)
+so other tools on this machine don't have to load the DB for every question.
+
+	./DBServer.py [--food db/food] [--money DBNAME] [--host 127.0.0.1] [--port 8080]
+
+	GET  /foods?tags=EXPR&where=CONDITIONS&sort=FIELD&limit=N&offset=N   (like FoodCMD list)
+	GET  /food/NAME?scale=F                                              (like FoodCMD show)
+	GET  /trade?value=V&from=UNIT&to=UNIT&when=TIME                      (Market.trade, hopping markets if needed)
+	GET  /valuation?unit=UNIT&when=TIME                                  (value of my repos, null if unknown)
+	GET  /metrics                                                        (request counts and latency)
+	POST /reload[?force=1]                                               (swap in the newest snapshots)
+
+The DBs are loaded once into a Snapshot that is never changed.  Every request uses the
+Snapshot that was current when it started, and /reload builds a new one on the side and
+then swaps it in with one assignment.  So readers never wait for a reload and never see
+half of one, and DB.save in another process only shows up after a /reload.
+"""
+import sys
+import os.path
+import json
+import math
+import time
+import threading
+import argparse
+import inspect
+import traceback
+from datetime import datetime
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from PlainTxtDB import DB, Tag
+from Instrument import Instrument
+from FoodIndex import FoodIndex
+from Money import parse_when, to_epoch
+import FoodDiff
+
+
+class Snapshot(object):
+	""" Everything loaded from one snapshot of each DB.  Treat it as read-only. """
+	def __init__(self, food_path, money_path=None):
+		self.loaded = time.time()
+		self.food_path = food_path
+		self.foods, name = DB.load(food_path)
+		self.food_name = os.path.basename(name)
+		self.by_name = {f.name: f for f in self.foods}
+		self.index = FoodIndex(self.foods)
+		self.money_path = money_path
+		self.system, name = DB.load(money_path) if money_path else (None, None)
+		self.money_name = os.path.basename(name) if name else None
+		# The FinanceSystem fills its caches (ledger, ratios, mapped price files) as it is used,
+		# which isn't safe from several threads at once.
+		self.money_lock = threading.Lock()
+
+	def names(self):
+		return {'food': self.food_name, 'money': self.money_name}
+
+
+class Metrics(object):
+	""" Request counts, errors and the latency of the last SAMPLES requests of each route """
+	SAMPLES = 1000
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.routes = {}
+
+	def record(self, route, seconds, error):
+		with self.lock:
+			r = self.routes.setdefault(route, {'count': 0, 'errors': 0, 'seconds': 0.0, 'samples': deque(maxlen=Metrics.SAMPLES)})
+			r['count'] += 1
+			r['errors'] += 1 if error else 0
+			r['seconds'] += seconds
+			r['samples'].append(seconds)
+
+	def report(self):
+		with self.lock:
+			routes = {k: dict(v, samples=sorted(v['samples'])) for k, v in self.routes.items()}
+		def pct(samples, p):
+			return samples[min(len(samples)-1, int(p * len(samples)))] if samples else None
+		out = {}
+		for name, r in sorted(routes.items()):
+			s = r.pop('samples')
+			r['mean_ms'] = 1000.0 * r['seconds'] / r['count']
+			for p in [0.5, 0.95, 0.99]:
+				r['p%d_ms'%int(p*100)] = 1000.0 * pct(s, p)
+			r['max_ms'] = 1000.0 * s[-1]
+			out[name] = r
+		return {'uptime': time.time() - self.started, 'routes': out}
+
+
+class NotFound(Exception):
+	pass
+
+
+class BadRequest(Exception):
+	""" The query arguments are wrong.  (So are KeyError and ValueError from parsing them.) """
+	pass
+
+
+def call(func, *args, **kwargs):
+	""" func(*args, **kwargs), but arguments \a func doesn't take are a BadRequest, not a TypeError from inside it """
+	try:
+		inspect.signature(func).bind(*args, **kwargs)
+	except TypeError as e:
+		raise BadRequest("Bad arguments: %s"%e)
+	return func(*args, **kwargs)
+
+
+class API(object):
+	""" The queries.  Each takes the Snapshot and the query arguments and returns something JSON can encode. """
+	def __init__(self, food_path, money_path=None):
+		self.snapshot = Snapshot(food_path, money_path)
+		self.metrics = Metrics()
+		self.reload_lock = threading.Lock() # only reloads wait for each other
+
+	def reload(self, force=False):
+		""" Load the newest snapshots and swap them in.  Unchanged DBs are not reloaded unless \a force. """
+		with self.reload_lock:
+			old = self.snapshot
+			newest = DB.snapshot(old.food_path)
+			newest_money = DB.snapshot(old.money_path) if old.money_path else None
+			if not force and newest == old.food_name and newest_money == old.money_name:
+				return {'reloaded': False, 'snapshots': old.names()}
+			with Instrument.timer('server.reload'):
+				snap = Snapshot(old.food_path, old.money_path)
+			self.snapshot = snap # the swap:  requests that already started keep the old one
+			return {'reloaded': True, 'snapshots': snap.names()}
+
+	def foods(self, snap, tags='', where='', sort='', limit=None, offset='0'):
+		limit = int(limit) if limit is not None else None
+		offset = int(offset)
+		try:
+			tagexpr, predicates = Tag.parse(tags), FoodIndex.parse(where)
+		except Exception as e:
+			raise BadRequest(str(e))
+		matches = snap.index.select(tagexpr, predicates)
+		try:
+			rows = FoodIndex.page(matches, sort, limit, offset) # checks the sort field before anything is sorted
+		except Exception as e:
+			raise BadRequest(str(e))
+		return {
+			'snapshot': snap.food_name,
+			'total': len(matches),
+			'offset': offset,
+			'foods': [{'name': f.name, 'description': f.description, 'tags': list(f.tags)} for f in rows],
+		}
+
+	def food(self, snap, name, scale='1.0'):
+		if name not in snap.by_name:
+			raise NotFound("No food named '%s'"%name)
+		f = snap.by_name[name]
+		factor = float(scale)
+		out = FoodDiff.food_record(f)
+		# Scale copies of the ingredients;  the Foods of a Snapshot are shared by every request
+		out['ingredients'] = [{'food': str(i.food), 'amount': i.amount*factor, 'unit': i.unit, 'prep': i.prep,
+			'text': (i*factor).str_amt()} for i in f.ingredients]
+		out['snapshot'] = snap.food_name
+		return out
+
+	def trade(self, snap, value, to, when=None, **kwargs):
+		system = self.money(snap)
+		value = float(value)
+		unit = kwargs['from']
+		when = parse_when(when) if when else datetime.utcnow()
+		with snap.money_lock:
+			ratio = self.ratios(system, unit, to, [when])[0]
+		if math.isnan(ratio):
+			raise NotFound("No price of %s in %s at %s"%(unit, to, when.isoformat()))
+		return {'value': value * ratio, 'unit': to, 'snapshot': snap.money_name}
+
+	def valuation(self, snap, unit, when=None):
+		system = self.money(snap)
+		when = parse_when(when) if when else datetime.utcnow()
+		if unit not in [str(u) for u in system.units]:
+			raise NotFound("No unit named '%s'"%unit)
+		with snap.money_lock:
+			repos, rows = system.valuation(unit, [when])
+		# A repo's value can't be known for the same reasons /trade is NotFound:  no markets connect
+		# its unit to \a unit or there's no price yet.  It is null and left out of the total.
+		values = {r.name: None if math.isnan(row[0]) else row[0] for r, row in zip(repos, rows)}
+		unknown = [name for name, v in values.items() if v is None]
+		return {'unit': unit, 'when': when.isoformat(), 'repos': values, 'unknown': unknown,
+			'total': sum(v for v in values.values() if v is not None), 'snapshot': snap.money_name}
+
+	def ratios(self, system, from_unit, to_unit, times):
+		""" system.conversion_ratios() (nan where unknown), but units no markets connect are NotFound """
+		try:
+			system.conversion_path(from_unit, to_unit)
+		except Exception as e:
+			raise NotFound(str(e))
+		return system.conversion_ratios(from_unit, to_unit, [to_epoch(t) for t in times])
+
+	def money(self, snap):
+		if not snap.system:
+			raise NotFound("No finance DB is loaded (start the server with --money)")
+		return snap.system
+
+
+class Handler(BaseHTTPRequestHandler):
+	api = None # set by serve()
+
+	def send_json(self, status, obj):
+		body = json.dumps(obj, default=str).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def route(self, method):
+		url = urlsplit(self.path)
+		parts = [unquote(p) for p in url.path.strip('/').split('/')]
+		args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+		api = self.api
+		snap = api.snapshot # one snapshot for the whole request
+		if method == 'POST':
+			if parts == ['reload']:
+				return 'reload', lambda: api.reload(bool(int(args.get('force', 0))))
+		elif parts == ['foods']:
+			return 'foods', lambda: call(api.foods, snap, **args)
+		elif parts[0] == 'food' and len(parts) == 2:
+			return 'food', lambda: call(api.food, snap, parts[1], **args)
+		elif parts == ['trade']:
+			return 'trade', lambda: call(api.trade, snap, **args)
+		elif parts == ['valuation']:
+			return 'valuation', lambda: call(api.valuation, snap, **args)
+		elif parts == ['metrics']:
+			return 'metrics', lambda: dict(api.metrics.report(), snapshots=snap.names())
+		return 'unknown', None
+
+	def handle_method(self, method):
+		t = time.perf_counter()
+		name, query = self.route(method)
+		status = 200
+		try:
+			if not query:
+				status, out = 404, {'error': "No such query %s %s"%(method, self.path)}
+			else:
+				out = query()
+		except NotFound as e:
+			status, out = 404, {'error': str(e)}
+		except KeyError as e:
+			status, out = 400, {'error': "Missing argument %s"%e}
+		except (BadRequest, ValueError) as e:
+			status, out = 400, {'error': str(e)}
+		except Exception as e:
+			# A bug, not a bad query
+			self.log_error("%s %s failed: %r", method, self.path, e)
+			sys.stderr.write(traceback.format_exc()) # log_error() would escape the newlines
+			status, out = 500, {'error': "Internal error: %s"%e}
+		self.send_json(status, out)
+		self.api.metrics.record(name, time.perf_counter() - t, status != 200)
+
+	def do_GET(self):
+		self.handle_method('GET')
+
+	def do_POST(self):
+		self.handle_method('POST')
+
+
+def serve(food_path, money_path=None, host='127.0.0.1', port=8080):
+	Handler.api = API(food_path, money_path)
+	server = ThreadingHTTPServer((host, port), Handler)
+	server.daemon_threads = True
+	print("Serving %s on http://%s:%d/"%(', '.join(n for n in Handler.api.snapshot.names().values() if n), host, server.server_port))
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--food', default='db/food', help="the food DB")
+	parser.add_argument('--money', default=None, help="a finance DB (optional)")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	args = parser.parse_args(Instrument.from_argv(sys.argv[1:]))
+	server = serve(args.food, args.money, args.host, args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		Instrument.stop()
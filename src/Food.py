@@ -14,6 +14,7 @@ class Ingredient(YAMLSetter):
 		\param prep:  might be 'sliced', 'steamed', 'sifted', etc.
 	"""
 	yaml_tag = "!Ingredient"
+	yaml_slots = True
 	yaml_props = {
 		'food': None,
 		'amount': 0.0,
@@ -140,6 +141,7 @@ class Food(YAMLSetter):
 	The food should specify its unit_mass and unit_volume so that it can be converted to any unit.
 	"""
 	yaml_tag="!Food"
+	yaml_slots = True
 	yaml_props = {
 		'name':'',  #A uniqe short name of the food.
 		'unit_mass': 1.0, # amount of mass per 'unit_label'
@@ -148,7 +150,7 @@ class Food(YAMLSetter):
 		'kcals': -1,  # kCalories per gram of this food (-1 means unknown)
 		'protein': -1, # protein per gram of this food (-1 means unknown)
 		'carbs': -1, # carbs per gram of this food (-1 means unknown)
-		'tags': [], # A list of tags for categorizing this food
+		'tags': [], # The tags for categorizing this food (kept as a shared tuple, see Tag.intern)
 		'description': '', #A longer description of the food
 		'ingredients': [], # A list of type <Ingredient>
 		'instructions': [], #A simple list of strings describing how to combine the ingredients.
@@ -173,7 +175,7 @@ class Food(YAMLSetter):
 	
 	def clear_tags(self):
 		""" Delete all the tags.  But retain the <RECIPE> tag if we are a recipe. """
-		self.tags = ['RECIPE'] if len(self.ingredients) else []
+		self.tags = Tag.intern(['RECIPE'] if len(self.ingredients) else [])
 	
 	def add_tag(self, tagname):
 		""" Add a new tag.  It is cleaned up and uppercased for you.  A duplicate tag will not be added."""
@@ -184,7 +186,7 @@ class Food(YAMLSetter):
 				raise Exception("'%s' cannot be in a tagname"%i)
 		tagname = tagname.upper()
 		if tagname not in self.tags:
-			self.tags.append(tagname)
+			self.tags = Tag.intern(self.tags + (tagname,))
 	
 	def scale(self, factor):
 		""" Scale this recipe by the given factor """
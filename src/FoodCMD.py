@@ -3,13 +3,19 @@
 This is a list of @cmd commands.  They are invoked automatically
 by reading the command line arguments.  Multiple commands can
 be called if listed sequentially on the command line.
-"""
 
+Startup is kept short for scripts that call it many times:  modules are imported
+by the commands that use them (see need()) and the database is only read when the
+first command that uses the foods runs, so 'help', 'verify', 'diff' and 'history'
+never load it.  The import times are in the --profile report.
+"""
+import time
+g_started = time.perf_counter()
 import sys
-from PlainTxtDB import DB, Tag
-from Food import Ingredient, Food
-from urllib.parse import quote
-from urllib.request import urlopen
+import os.path
+import importlib
+from Instrument import Instrument
+g_import_time = time.perf_counter() - g_started
 
 g_usage = """
 USAGE:
@@ -32,31 +38,101 @@ EXAMPLES:
 		
 	To copy the db to a new location
 		./FoodCMD.py load "db/foods1" list save "db/foods2"
+		
+	To store the db one record per food and then change one recipe 
+	without reading the rest
+		./FoodCMD.py format table save
+		./FoodCMD.py load db/food only="Eggy Sauce" food "Eggy Sauce" show save
+		
+	To see where the time goes (JSON report on stderr or in FILE)
+		./FoodCMD.py --profile[=FILE] [--cprofile[=N]] [--tracemalloc[=N]] list
+	The report has the startup and import.MODULE times as well
+	or set ORG_PROFILE=FILE (and ORG_PROFILE_CPROFILE=N, ORG_PROFILE_TRACEMALLOC=N)
 
 COMMANDS:"""
 
 
 g_cmds = {}
 g_dbname = ''
+g_loaded = None # the snapshot g_foods came from
 g_foods = None
 g_food = None
+g_index = None # FoodIndex of g_foods.  Commands that change foods reset it.
+g_pending = None # (fallback, only) of a load that hasn't been done yet
 
-def cmd(func):
+def cmd(func, data=True):
 	""" This is a decorator that wraps a function and adds it to the
-	global list of commands g_cmds.
+	global list of commands g_cmds.  The function cmd_NAME is the command NAME
+	(so commands like list and set don't hide the builtins).
+	The database is loaded before a command with \a data runs.
 	"""
+	name = func.__name__[len('cmd_'):]
 	def do_cmd(args, kvargs):
-		print("\n_____%s %s %s\n"%(func.__name__, args, kvargs))
-		func(*args, **kvargs)
+		print("\n_____%s %s %s\n"%(name, args, kvargs))
+		with Instrument.timer('cmd.' + name):
+			if data:
+				load_pending()
+			func(*args, **kvargs)
 	# add the command to the global set of commands
 	global g_cmds
 	do_cmd.__doc__ = func.__doc__
-	g_cmds[func.__name__] = do_cmd
+	g_cmds[name] = do_cmd
 	return func
 
 
+def nodata(func):
+	""" A @cmd that doesn't use the foods, so it doesn't wait for them to load """
+	return cmd(func, data=False)
+
+
+def need(name):
+	""" Import the module \a name the first time a command needs it.  Timed as import.NAME """
+	module = sys.modules.get(name)
+	if module is None:
+		with Instrument.timer('import.' + name):
+			module = importlib.import_module(name)
+	return module
+
+
+def load_pending():
+	""" Read the database the last load command named, if it hasn't been read yet """
+	global g_foods, g_loaded, g_pending
+	if g_pending is None:
+		return
+	fallback, only = g_pending
+	g_pending = None
+	if only:
+		g_foods, g_loaded = need('FoodTable').FoodTable.load_partial(g_dbname, only.split(','))
+		return
+	need('Food') # the YAML tags of the classes in a snapshot are registered by importing them
+	need('FoodTable')
+	try:
+		g_foods, g_loaded = need('PlainTxtDB').DB.load(g_dbname, fallback=fallback)
+	except:
+		print("Couldn't load database '%s'"%g_dbname)
+
+
+def find_food(name):
+	""" The food \a name or None.  After a partial load it is read now if it wasn't (see FoodTable.find) """
+	global g_index
+	if getattr(g_foods, 'loaded', None) is None:
+		return g_foods[g_foods.index(name)] if name in g_foods else None
+	n = len(g_foods)
+	food = g_foods.find(name)
+	if len(g_foods) != n:
+		g_index = None
+	return food
+
+
+def food_index():
+	global g_index
+	if g_index is None:
+		g_index = need('FoodIndex').FoodIndex(g_foods)
+	return g_index
+
+
 @cmd
-def set(attr, value):
+def cmd_set(attr, value):
 	"""
 	set ATTR VALUE
 		Set the current working food's attribute ATTR to VALUE
@@ -69,7 +145,7 @@ def set(attr, value):
 		  * unit_label
 		  * description
 	"""
-	global g_food
+	global g_food, g_index
 	if not g_food: raise Exception("You must select a food first.")
 	
 	if attr not in ['kcals', 'protein', 'carbs', 'unit_mass', 'unit_volume', 'unit_label', 'description']:
@@ -79,10 +155,11 @@ def set(attr, value):
 		value = float(value)
 	
 	setattr(g_food, attr, value)
+	g_index = None
 	
 
 @cmd
-def show(factor=1.0):
+def cmd_show(factor=1.0):
 	"""
 	show [FACTOR]
 		Show all the information about the current food.
@@ -94,11 +171,17 @@ def show(factor=1.0):
 	
 
 @cmd
-def list(tagexpr='', verbose=False):
+def cmd_list(tagexpr='', verbose=False, where='', sort='', limit=None, offset=0):
 	"""
-	list [TAGEXPR]
+	list [TAGEXPR] [where=CONDITIONS] [sort=FIELD] [limit=N] [offset=N]
 		You can specify a TAGEXPR to filter the results.
 		The tag name 'recipe' filters for foods that have a recipe.
+		CONDITIONS are comparisons of kcals, protein, carbs (per 
+		gram), unit_mass (grams) or unit_volume (ml) of one 
+		unit_label joined with &.  Foods where the value is 
+		unknown (-1) never match.
+		sort=FIELD orders by name or a numeric field (-FIELD for 
+		largest first).  limit and offset show one page of the result.
 		
 		Examples:
 		
@@ -110,50 +193,78 @@ def list(tagexpr='', verbose=False):
 							ice cream
 		list "dessert & healthy & delicious" # Only healty, delicious
 							desserts
+		list dessert where="kcals < 3 & protein > 0.1"
+							# Light desserts with
+							some protein
+		list dessert sort=kcals limit=20     # The 20 lightest
+							desserts
+		list sort=name limit=20 offset=20    # The second page
 	"""
 	global g_foods
-	for f in Tag.filter(g_foods, tagexpr):
+	Tag = need('PlainTxtDB').Tag
+	FoodIndex = need('FoodIndex').FoodIndex
+	if where:
+		try:
+			foods = food_index().select(Tag.parse(tagexpr), FoodIndex.parse(where))
+		except Exception as e:
+			print("Syntax Error: %s"%e)
+			return
+	else:
+		foods = Tag.filter(g_foods, tagexpr)
+	limit = int(limit) if limit is not None else None
+	offset = int(offset)
+	try:
+		rows = FoodIndex.page(foods, sort, limit, offset)
+	except Exception as e:
+		print("Syntax Error: %s"%e)
+		return
+	shown = 0
+	for f in rows:
+		shown += 1
 		if verbose:
 			print(f.verbose())
 		else:
 			print(" - %s%s%s  %s"%(f, ' : ' if f.description else '', f.description, '<' + '> <'.join(f.tags) + '>'))
+	if limit is not None or offset:
+		print("(%d-%d of %d)"%(offset + 1 if shown else offset, offset + shown, len(foods)))
 
 @cmd
-def new(name, desc=""):
+def cmd_new(name, desc=""):
 	"""
 	new NAME [DESC]
 		If food does not exist then create it with optional
 		description DESC.
 		Set food NAME as the current working food.
 	"""
-	global g_foods, g_food
-	if name in g_foods:
-		g_food = g_foods[g_foods.index(name)]
-	else:
-		g_food = Food(name=name, description=desc)
+	global g_foods, g_food, g_index
+	g_food = find_food(name)
+	if not g_food:
+		g_food = need('Food').Food(name=name, description=desc)
 		g_foods.append(g_food)
+		g_index = None
 
 
 @cmd
-def food(name):
+def cmd_food(name):
 	"""
 	food NAME
 		Set food NAME as the current working food.
 	"""
 	global g_foods, g_food
-	if name not in g_foods:
+	g_food = find_food(name)
+	if not g_food:
 		raise Exception("'%s' does not exist.  Create it with the 'new' command."%name)
-	g_food = g_foods[ g_foods.index(name)]
 
 
 @cmd
-def delete(name):
+def cmd_delete(name):
 	"""
 	delete NAME
 		Delete the food NAME from the database.  You cannot delete 
 		a food that is used as an ingredient.
 	"""
-	global g_foods, g_food
+	global g_foods, g_food, g_index
+	find_food(name) # read it after a partial load.  Recipes that weren't read are checked by the save.
 	if max([ing==name for food in g_foods for ing in food.ingredients]):
 		print("'%s' is used as an ingredient.  It cannot be deleted"%name)
 		return
@@ -162,55 +273,153 @@ def delete(name):
 	if name not in g_foods:
 		print("Couldn't find '%s'"%name)
 	g_foods.remove(name)
+	g_index = None
 
 
-@cmd
-def load(dbname='db/food'):
+@nodata
+def cmd_load(dbname='db/food', fallback=False, only=None):
 	"""
-	load [DBNAME]
+	load [DBNAME] [fallback=1] [only=NAME[,NAME...]]
 		Loads a food database DBNAME.
 		This command is optional.  It is implicitly added as the first 
-		command if missing.
+		command if missing.  The foods are read when a command first
+		needs them.
+		With fallback=1 a corrupt newest snapshot is skipped and the 
+		next older good one is loaded.
+		With only=NAMES just those foods and their ingredients are
+		loaded.  The database must be in the table format.
 	"""
-	global g_foods, g_dbname
-	try:
-		g_foods, name = DB.load(dbname)
-		g_dbname = dbname
-	except:
-		print("Couldn't load database '%s'"%dbname)
+	global g_foods, g_dbname, g_loaded, g_index, g_pending
+	g_dbname = dbname
+	g_foods = g_loaded = g_index = None
+	g_pending = (bool(int(fallback)), only)
 
 
 @cmd
-def save(dbname=None):
+def cmd_save(dbname=None):
 	"""
 	save [DBNAME]
 		Save the current foods to DBNAME.  Or back where it came 
 		from if no DBNAME is given.
+		If someone else saved the database since it was loaded then 
+		their changes are merged in.  The save fails if the same 
+		food was changed on both sides.
 	"""
-	global g_foods, g_dbname
+	global g_foods, g_dbname, g_loaded, g_index
 	if not dbname:
 		dbname = g_dbname
+	base = g_loaded if dbname == g_dbname else None
 	g_dbname = dbname
-	DB.save(g_foods, g_dbname)
+	FoodDiff = need('FoodDiff')
+	g_loaded = need('PlainTxtDB').DB.save(g_foods, g_dbname, base=base, merge=FoodDiff.merge)
+	g_index = None # a merge may have changed the foods
+	# The foods are in memory so remember their diff records now instead of parsing the snapshot later
+	if getattr(g_foods, 'loaded', None) is None:
+		FoodDiff.prime(g_dbname, os.path.basename(g_loaded), g_foods)
 
 
 @cmd
-def ingd(food, amount, prep=""):
+def cmd_format(kind):
+	"""
+	format yaml|table
+		How the next save stores the foods.  yaml is one YAML document
+		where ingredients are anchors to foods.  table is one record 
+		per food with ingredients by name, which can be loaded in part.
+	"""
+	global g_foods
+	FoodTable = need('FoodTable').FoodTable
+	if kind == 'table':
+		if not isinstance(g_foods, FoodTable):
+			g_foods = FoodTable(g_foods)
+	elif kind == 'yaml':
+		if getattr(g_foods, 'loaded', None) is not None:
+			raise Exception("Only part of the database is loaded.  Load all of it to change its format.")
+		g_foods = list(g_foods)
+	else:
+		raise Exception("Unknown format '%s'.  Use yaml or table."%kind)
+
+
+@nodata
+def cmd_verify(dbname=None, workers=None):
+	"""
+	verify [DBNAME] [workers=N]
+		Check every snapshot of DBNAME (default: the loaded one) against
+		its recorded checksum using N processes.  Snapshots saved 
+		before checksums existed are only checked to parse.
+	"""
+	results = need('PlainTxtDB').DB.verify(dbname or g_dbname, int(workers) if workers else None)
+	for filename, status, message in results:
+		if status != 'ok':
+			print(" %-9s %s  %s"%(status.upper(), filename, message))
+	bad = len([r for r in results if r[1] == 'corrupt'])
+	print("%d snapshots checked, %d corrupt"%(len(results), bad))
+
+
+@nodata
+def cmd_diff(old=-2, new=-1):
+	"""
+	diff [OLD] [NEW]
+		Show what changed between two snapshots of the loaded database.
+		OLD and NEW are snapshot names, timestamp prefixes 
+		('2017-04-06') or negative indexes (-1 is the newest).
+		The default compares the two newest snapshots.
+		Use "current" as NEW to compare with the foods in memory.
+	"""
+	DB = need('PlainTxtDB').DB
+	FoodDiff = need('FoodDiff')
+	older = FoodDiff.snapshot_records(g_dbname, DB.snapshot(g_dbname, old))
+	if new == 'current':
+		load_pending()
+		newer = FoodDiff.food_records(g_foods)
+	else:
+		newer = FoodDiff.snapshot_records(g_dbname, DB.snapshot(g_dbname, new))
+	d = FoodDiff.diff(older, newer)
+	print('\n'.join(FoodDiff.format_diff(d)))
+	print("%d added, %d removed, %d changed"%(len(d['added']), len(d['removed']), len(d['changed'])))
+
+
+@nodata
+def cmd_history(tagexpr='', food=None, ingredient=None, field=None, workers=None):
+	"""
+	history [TAGEXPR] [food=NAME [ingredient=NAME | field=NAME]] [workers=N]
+		Look through every snapshot of the loaded database.
+		With TAGEXPR show how many foods matched it over time.
+		With food=NAME and ingredient=NAME show when the amount of
+		that ingredient in the recipe changed.
+		With food=NAME and field=NAME show when that field changed.
+	"""
+	from functools import partial
+	FoodHistory = need('FoodHistory')
+	if food and ingredient:
+		extract = partial(FoodHistory.ingredient, food, ingredient)
+	elif food:
+		extract = partial(FoodHistory.field, food, field or 'description')
+	else:
+		extract = partial(FoodHistory.count_tags, tagexpr)
+	results = FoodHistory.query(g_dbname, extract, workers=int(workers) if workers else None)
+	for when, value in FoodHistory.changes(results):
+		print(" %s  %s"%(when, value))
+
+
+@cmd
+def cmd_ingd(food, amount, prep=""):
 	"""
 	ingd FOOD AMOUNT [PREP]
 		Add an ingredient to the current food.
 		The AMOUNT can be a easy string "1 1/2 cup" 
 		PREP is an optional preperation ("sliced", "diced", etc.)
 	"""
-	global g_food, g_foods
+	global g_food, g_foods, g_index
 	if not g_food: raise Exception("You must select a food first.")
-	if food not in g_foods:
+	ingredient = find_food(food)
+	if not ingredient:
 		raise Exception("'%s' is not a food"%food)
-	g_food.add_ingredient(g_foods[g_foods.index(food)], amount, prep)
+	g_food.add_ingredient(ingredient, amount, prep)
+	g_index = None
 
 
 @cmd
-def inst(text):
+def cmd_inst(text):
 	"""
 	inst TEXT
 		Add a new instruction to the recipe.
@@ -221,22 +430,25 @@ def inst(text):
 	
 
 @cmd
-def tag(name):
+def cmd_tag(name):
 	"""
 	tag NAME
 		Add tag NAME to the current working food.
 	"""
-	global g_food
+	global g_food, g_index
 	if not g_food: raise Exception("You must select a food first.")
 	g_food.add_tag(name)
+	g_index = None
 
 
-@cmd
-def usda(search):
+@nodata
+def cmd_usda(search):
 	"""
 	usda SEARCH
 		Search the USDA food database for SEARCH.
 	"""
+	from urllib.parse import quote
+	from urllib.request import urlopen
 	searchquote = quote(search)
 	print(searchquote)
 	
@@ -250,8 +462,8 @@ def usda(search):
 	# TODO
 	
 
-@cmd
-def help():
+@nodata
+def cmd_help():
 	"""
 	help
 		Print this help
@@ -261,7 +473,9 @@ def help():
 
 if __name__=='__main__':
 	try:
-		argv = sys.argv[1:] # get rid of the name of the file
+		argv = Instrument.from_argv(sys.argv[1:]) # get rid of the name of the file and the profiling options
+		Instrument.add('startup.imports', g_import_time)
+		Instrument.add('startup', time.perf_counter() - g_started)
 		# implicity add 'load' as the first command if needed
 		if argv[0] != 'load':
 			argv = ['load'] + argv
@@ -276,7 +490,7 @@ if __name__=='__main__':
 			argkv = {}
 			for i, arg in enumerate(argv[1:next_cmd]):
 				if '=' in arg:
-					k,v = arg.split('=')
+					k,v = arg.split('=', 1)
 					argkv[k]=v
 				else:
 					args.append(arg)
@@ -288,3 +502,5 @@ if __name__=='__main__':
 		print(g_usage)
 		for c in sorted(g_cmds.keys()):
 			print(g_cmds[c].__doc__)
+	finally:
+		Instrument.stop()
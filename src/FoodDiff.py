@@ -0,0 +1,278 @@
+"""
+Compare two versions of a food database:  which foods were added, removed or changed
+and, for a changed food, which fields, tags and ingredients changed.
+
+Every food is reduced to a plain record where ingredients refer to foods by name,
+so the unstable &idNNN anchors of the snapshots don't matter.  Each record also gets
+a content digest so unchanged foods are skipped with one comparison.
+
+Records of a snapshot are read from the composed YAML nodes (no Food objects are built)
+and cached in <db>/cache/ because snapshots never change.
+"""
+import hashlib
+import yaml
+from PlainTxtDB import DB, Tag, ConflictError
+from Food import Food, Ingredient
+from FoodTable import FoodTable
+
+FIELDS = [k for k in Food.yaml_props if k not in ['tags', 'ingredients', 'instructions']]
+CACHE_KIND = 'foods1' # bump when the record format changes
+LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+
+def digest(record):
+	return hashlib.sha1(repr(sorted(record.items())).encode('utf-8')).digest()[:16]
+
+
+def food_record(food):
+	""" The record of a Food object """
+	record = {k: getattr(food, k, Food.yaml_props[k]) for k in FIELDS}
+	record['tags'] = tuple(food.tags)
+	record['instructions'] = tuple(food.instructions)
+	record['ingredients'] = tuple((str(i.food), i.amount, i.unit, i.prep) for i in food.ingredients)
+	return record
+
+
+def food_records(foods):
+	""" {name: (digest, record)} of a list of Food objects """
+	out = {}
+	for f in foods:
+		r = food_record(f)
+		out[r['name']] = (digest(r), r)
+	return out
+
+
+def _scalar(node):
+	tag = node.tag.rsplit(':', 1)[-1]
+	try:
+		if tag == 'int':
+			return int(node.value)
+		if tag == 'float':
+			return float(node.value)
+	except ValueError:
+		pass
+	if tag == 'null':
+		return None
+	if tag == 'bool':
+		return node.value.lower() in ['true', 'yes', 'on']
+	return node.value
+
+
+def _mapping(node):
+	return {k.value: v for k, v in node.value}
+
+
+def _value(node):
+	if isinstance(node, yaml.SequenceNode):
+		return tuple(_value(n) for n in node.value)
+	if isinstance(node, yaml.MappingNode):
+		return _mapping(node)
+	return _scalar(node)
+
+
+def node_records(root):
+	""" {name: (digest, record)} of the foods in a composed snapshot (a sequence of !Food nodes) """
+	out = {}
+	for node in root.value:
+		m = _mapping(node)
+		r = {k: _value(m[k]) if k in m else Food.yaml_props[k] for k in FIELDS}
+		r['tags'] = _value(m['tags']) if 'tags' in m else ()
+		r['instructions'] = _value(m['instructions']) if 'instructions' in m else ()
+		ingredients = []
+		for ing in (m['ingredients'].value if 'ingredients' in m else []):
+			i = _mapping(ing)
+			ingredients.append((_scalar(_mapping(i['food'])['name']), _value(i['amount']), _value(i['unit']), _value(i['prep'])))
+		r['ingredients'] = tuple(ingredients)
+		out[r['name']] = (digest(r), r)
+	return out
+
+
+def table_records(records):
+	""" {name: (digest, record)} of the plain records of a FoodTable file """
+	out = {}
+	for rec in records:
+		r = {k: rec.get(k, Food.yaml_props[k]) for k in FIELDS}
+		r['tags'] = tuple(rec.get('tags', ()))
+		r['instructions'] = tuple(rec.get('instructions', ()))
+		r['ingredients'] = tuple(tuple(i) for i in rec.get('ingredients', ()))
+		out[r['name']] = (digest(r), r)
+	return out
+
+
+def snapshot_records(path, name):
+	""" The records of the snapshot \a name in the DB directory \a path (cached) """
+	def compute(filename):
+		with open(filename, 'rb') as f:
+			root = yaml.compose(f, Loader=LOADER)
+		if root.tag == FoodTable.yaml_tag: # the foods are in their own file
+			return table_records(FoodTable.read_records(path, _mapping(root)['file'].value))
+		return node_records(root)
+	return DB.cached(path, name, CACHE_KIND, compute)
+
+
+def prime(path, name, foods):
+	""" Cache the records of the snapshot \a name that was just saved from \a foods, so it is never parsed """
+	DB.cached(path, name, CACHE_KIND, lambda filename: food_records(foods))
+
+
+def diff_food(old, new):
+	""" The changes between two records of one food as a list of (what, old, new) """
+	changes = []
+	for k in FIELDS:
+		if old[k] != new[k]:
+			changes.append((k, old[k], new[k]))
+	for t in new['tags']:
+		if t not in old['tags']:
+			changes.append(('tag', None, t))
+	for t in old['tags']:
+		if t not in new['tags']:
+			changes.append(('tag', t, None))
+	old_ing = {i[0]: i for i in old['ingredients']}
+	new_ing = {i[0]: i for i in new['ingredients']}
+	for name, i in new_ing.items():
+		if name not in old_ing:
+			changes.append(('ingredient', None, i))
+		elif old_ing[name] != i:
+			changes.append(('ingredient', old_ing[name], i))
+	for name, i in old_ing.items():
+		if name not in new_ing:
+			changes.append(('ingredient', i, None))
+	if old['instructions'] != new['instructions']:
+		changes.append(('instructions', old['instructions'], new['instructions']))
+	return changes
+
+
+def diff(old, new):
+	"""
+	Compare two {name: (digest, record)} tables.
+	Returns {'added': [names], 'removed': [names], 'changed': {name: [(what, old, new), ...]}}
+	"""
+	out = {'added': [], 'removed': [], 'changed': {}}
+	for name, (d, record) in new.items():
+		if name not in old:
+			out['added'].append(name)
+		elif old[name][0] != d:
+			changes = diff_food(old[name][1], record)
+			if changes: # the digest also sees 1 vs 1.0
+				out['changed'][name] = changes
+	out['removed'] = [name for name in old if name not in new]
+	return out
+
+
+def diff_snapshots(path, old=-2, new=-1):
+	""" diff() two snapshots of the DB at \a path.  See DB.snapshot() for how they are named. """
+	return diff(snapshot_records(path, DB.snapshot(path, old)), snapshot_records(path, DB.snapshot(path, new)))
+
+
+def format_diff(d):
+	""" A diff() as lines of text """
+	def ing(i):
+		return '%s %s %s%s'%(i[0], i[1], i[2], ' (%s)'%i[3] if i[3] else '')
+	lines = ['+ %s'%n for n in sorted(d['added'])] + ['- %s'%n for n in sorted(d['removed'])]
+	for name in sorted(d['changed']):
+		lines.append('~ %s'%name)
+		for what, a, b in d['changed'][name]:
+			if what == 'ingredient':
+				a, b = (ing(a) if a else None), (ing(b) if b else None)
+			if a is None:
+				lines.append('    + %s: %s'%(what, b))
+			elif b is None:
+				lines.append('    - %s: %s'%(what, a))
+			else:
+				lines.append('    ~ %s: %s -> %s'%(what, a, b))
+	return lines
+
+
+def merge(base, theirs, ours):
+	"""
+	Three-way merge of lists of Foods for DB.save().  A food changed (or added, or removed)
+	on only one side takes that side's version.  A food changed differently on both sides
+	is a conflict.  \a ours is updated in place (so the caller sees the merged foods) and returned.
+	If \a ours is a partially loaded FoodTable the foods it never loaded are taken as unchanged.
+	"""
+	old = food_records(base)
+	mine = food_records(ours)
+	loaded = getattr(ours, 'loaded', None)
+	if loaded is not None:
+		mine.update((name, rec) for name, rec in old.items() if name not in loaded)
+	yours = food_records(theirs)
+	ours_by_name = {f.name: f for f in ours}
+	theirs_by_name = {f.name: f for f in theirs}
+	merged = {}
+	conflicts = []
+	for name in list(yours) + [n for n in mine if n not in yours]:
+		b, t, o = [table[name][1] if name in table else None for table in (old, yours, mine)]
+		if o == b or o == t:
+			pick = theirs_by_name.get(name)
+		elif t == b:
+			pick = ours_by_name.get(name)
+		else:
+			conflicts.append(name)
+			continue
+		if pick is not None:
+			merged[name] = pick
+	for f in merged.values():
+		for i in f.ingredients:
+			if str(i.food) not in merged and str(i.food) not in conflicts:
+				conflicts.append("%s (uses the removed %s)"%(f.name, i.food))
+	if conflicts:
+		raise ConflictError("Both sides changed: %s"%', '.join(conflicts))
+	# The foods come from two object graphs.  Point every ingredient at the merged food.
+	for f in merged.values():
+		for i in f.ingredients:
+			i.food = merged[str(i.food)]
+	ours[:] = list(merged.values())
+	if loaded is not None:
+		# theirs was loaded in full, so ours has every food now.  Its old record file must not
+		# be copied again:  that would bring back the foods they deleted.
+		ours.loaded = None
+	return ours
+
+
+def update(foods, old, new):
+	"""
+	Bring the list \a foods, loaded from the snapshot with the records \a old and maybe edited
+	since, up to the snapshot with the records \a new.  Only the foods that differ are touched:
+	changed foods are updated in place (so anything showing them stays valid), new ones are
+	appended and removed ones are taken out.  A food that was edited here is left as it is.
+	Returns (names that were updated, names that were kept because of local edits).
+	"""
+	d = diff(old, new)
+	byname = {f.name: f for f in foods}
+	updated = []
+	kept = []
+	for name in d['added'] + list(d['changed']) + d['removed']:
+		local = food_record(byname[name]) if name in byname else None
+		if local == (new[name][1] if name in new else None):
+			continue # already the same here
+		if local != (old[name][1] if name in old else None):
+			kept.append(name)
+		else:
+			updated.append(name)
+	# New foods first so the ingredients can refer to them
+	for name in updated:
+		if name in new and name not in byname:
+			byname[name] = Food(name=name)
+			foods.append(byname[name])
+	for name in list(updated):
+		if name not in new:
+			continue
+		r = new[name][1]
+		if any(i[0] not in byname for i in r['ingredients']):
+			updated.remove(name)
+			kept.append(name) # uses a food that was kept out
+			continue
+		f = byname[name]
+		for k in FIELDS:
+			setattr(f, k, r[k])
+		f.tags = Tag.intern(r['tags'])
+		f.instructions = list(r['instructions'])
+		f.ingredients = [Ingredient(food=byname[n], amount=a, unit=u, prep=p) for n, a, u, p in r['ingredients']]
+	for name in list(updated):
+		if name not in new:
+			if any(str(i.food) == name for f in foods for i in f.ingredients):
+				updated.remove(name)
+				kept.append(name) # still used by a recipe edited here
+			else:
+				foods.remove(byname.pop(name))
+	return (updated, kept)
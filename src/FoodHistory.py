@@ -0,0 +1,85 @@
+"""
+Ask questions of every snapshot of a food database:
+
+	When did the amount of butter in "Eggy Sauce" change?
+		changes(query('db/food', partial(ingredient, 'Eggy Sauce', 'butter')))
+	How many foods were desserts over time?
+		query('db/food', partial(count_tags, 'dessert'))
+
+An extractor is a module level function (or a functools.partial of one) so it can be sent
+to the worker processes.  It gets the {name: (digest, record)} table of one snapshot (see
+FoodDiff) and returns something small.  The snapshots are spread over a process pool, each
+result is cached in <db>/cache/ and the results come back in time order as they are ready.
+"""
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from PlainTxtDB import DB, Tag, TagSet
+import FoodDiff
+
+
+def query_key(extract):
+	""" A name for the cache files of \a extract that changes with its arguments """
+	if isinstance(extract, partial):
+		text = '%s.%s%r%r'%(extract.func.__module__, extract.func.__qualname__, extract.args, sorted(extract.keywords.items()))
+	else:
+		text = '%s.%s'%(extract.__module__, extract.__qualname__)
+	return 'q' + hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def _run(job):
+	""" Run one extractor on one snapshot (in a worker process) """
+	path, name, key, extract = job
+	return DB.cached(path, name, key, lambda filename: extract(FoodDiff.snapshot_records(path, name)))
+
+
+def query(path, extract, start=None, end=None, workers=None):
+	"""
+	Yield (timestamp, extract(records)) for every snapshot of the DB at \a path between
+	\a start and \a end (datetimes, inclusive), oldest first.
+	"""
+	times = [t for t in reversed(DB.snapshots(path)) if (not start or t >= start) and (not end or t <= end)]
+	key = query_key(extract)
+	jobs = [(path, t.strftime(DB.FILENAME_FMT), key, extract) for t in times]
+	if workers == 1 or len(jobs) < 2:
+		results = map(_run, jobs)
+		for t, r in zip(times, results):
+			yield (t, r)
+		return
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		for t, r in zip(times, pool.map(_run, jobs)):
+			yield (t, r)
+
+
+def changes(results):
+	""" Only the (timestamp, value) pairs of \a results where the value is different from the one before """
+	first = True
+	last = None
+	for t, value in results:
+		if first or value != last:
+			yield (t, value)
+		first = False
+		last = value
+
+
+# Extractors
+
+def count_tags(tagexpr, records):
+	""" The number of foods matching the tag expression \a tagexpr """
+	expr = Tag.parse(tagexpr)
+	return sum(1 for d, r in records.values() if Tag.match(TagSet(r['tags']), expr))
+
+
+def field(food, name, records):
+	""" The field \a name of \a food ('tags', 'kcals', ...) or None if there was no such food """
+	return records[food][1][name] if food in records else None
+
+
+def ingredient(recipe, food, records):
+	""" (amount, unit, prep) of \a food in \a recipe, or None """
+	if recipe not in records:
+		return None
+	for i in records[recipe][1]['ingredients']:
+		if i[0] == food:
+			return i[1:]
+	return None
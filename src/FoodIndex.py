@@ -0,0 +1,127 @@
+"""
+Find foods by tags and ranges of their numeric fields:
+
+	FoodIndex(foods).select('dessert & recipe', FoodIndex.parse('kcals < 3 & protein > 0.1'))
+
+Every numeric field (kcals, protein and carbs per gram, unit_mass and unit_volume:  the grams
+and ml of one unit_label) is kept as a sorted array of values with the row of each value, so a
+range is two bisects.  -1 means unknown and unknown values are left out of the index, so they
+never match a range.
+Foods with the same tags share one tag tuple (see Tag.intern) so a tag expression is
+matched once per distinct tuple.  The row sets of every predicate are intersected,
+smallest first.
+
+FoodIndex.page() sorts and pages the result:  the top k of n foods are kept in a heap
+(O(n log k)) and the foods are only yielded, so the caller formats just the page.
+"""
+import re
+import heapq
+from itertools import islice
+from array import array
+from bisect import bisect_left, bisect_right
+from PlainTxtDB import Tag, TagSet
+
+
+class FoodIndex(object):
+	FIELDS = ['kcals', 'protein', 'carbs', 'unit_mass', 'unit_volume'] # per gram, then the grams and ml of one unit_label
+	UNKNOWN = -1
+	OPS = ['<=', '>=', '<', '>', '=']
+	PREDICATE = re.compile(r'^\s*(\w+)\s*(<=|>=|==|<|>|=)\s*([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)\s*(?:/g)?\s*$')
+
+	def __init__(self, foods):
+		self.foods = list(foods)
+		self.values = {} # field -> sorted array of the known values
+		self.rows = {} # field -> the row in foods of each value
+		for k in FoodIndex.FIELDS:
+			pairs = []
+			for i, f in enumerate(self.foods):
+				v = getattr(f, k, FoodIndex.UNKNOWN)
+				if isinstance(v, (int, float)) and v != FoodIndex.UNKNOWN:
+					pairs.append((float(v), i))
+			pairs.sort()
+			self.values[k] = array('d', [v for v, i in pairs])
+			self.rows[k] = array('i', [i for v, i in pairs])
+		self.tagsets = {} # tag tuple -> rows
+		for i, f in enumerate(self.foods):
+			self.tagsets.setdefault(tuple(f.tags), []).append(i)
+
+	@staticmethod
+	def parse(text):
+		""" Turn 'kcals < 3 & protein >= 0.1/g' into [('kcals', '<', 3.0), ('protein', '>=', 0.1)] """
+		out = []
+		for part in text.split('&'):
+			if not part.strip():
+				continue
+			m = FoodIndex.PREDICATE.match(part)
+			if not m:
+				raise Exception("Can't understand '%s'.  Use FIELD OP NUMBER like 'kcals < 3'"%part.strip())
+			field, op, value = m.groups()
+			if field not in FoodIndex.FIELDS:
+				raise Exception("'%s' is not one of %s"%(field, ', '.join(FoodIndex.FIELDS)))
+			out.append((field, '=' if op == '==' else op, float(value)))
+		return out
+
+	def range(self, field, op, value):
+		""" The set of rows where \a field \a op \a value """
+		values = self.values[field]
+		lo, hi = 0, len(values)
+		if op == '<':
+			hi = bisect_left(values, value)
+		elif op == '<=':
+			hi = bisect_right(values, value)
+		elif op == '>':
+			lo = bisect_right(values, value)
+		elif op == '>=':
+			lo = bisect_left(values, value)
+		elif op == '=':
+			lo, hi = bisect_left(values, value), bisect_right(values, value)
+		else:
+			raise Exception("Unknown operator %s"%op)
+		return set(self.rows[field][lo:hi])
+
+	def tagged(self, tagexpr):
+		""" The set of rows matching \a tagexpr """
+		if isinstance(tagexpr, str):
+			tagexpr = Tag.parse(tagexpr)
+		rows = set()
+		for tags, r in self.tagsets.items():
+			if Tag.match(TagSet(tags), tagexpr):
+				rows.update(r)
+		return rows
+
+	def select(self, tagexpr='', where=()):
+		""" The foods matching \a tagexpr and every (field, op, value) of \a where, in their original order """
+		sets = [self.range(*p) for p in where]
+		if tagexpr:
+			sets.append(self.tagged(tagexpr))
+		if not sets:
+			return list(self.foods)
+		sets.sort(key=len)
+		rows = sets[0].intersection(*sets[1:])
+		return [self.foods[i] for i in sorted(rows)]
+
+	@staticmethod
+	def page(foods, sort=None, limit=None, offset=0):
+		"""
+		Yield the foods from \a offset to \a offset + \a limit after sorting them by the field \a sort
+		('kcals', 'name', ...;  '-kcals' for largest first).  Unknown values come last and foods
+		with equal values keep their order in \a foods, so the pages of one snapshot are stable.
+		"""
+		end = offset + limit if limit is not None else None
+		if not sort:
+			return islice(foods, offset, end)
+		field = sort.lstrip('-')
+		desc = sort.startswith('-')
+		if field not in FoodIndex.FIELDS + ['name']:
+			raise Exception("Can't sort by '%s'.  Use name or one of %s"%(field, ', '.join(FoodIndex.FIELDS)))
+		def key(row):
+			i, f = row
+			v = getattr(f, field, FoodIndex.UNKNOWN)
+			known = field == 'name' or v != FoodIndex.UNKNOWN
+			return (known, v, -i) if desc else (not known, v, i)
+		rows = enumerate(foods)
+		if end is None:
+			rows = sorted(rows, key=key, reverse=desc)
+		else:
+			rows = (heapq.nlargest if desc else heapq.nsmallest)(end, rows, key=key)
+		return (f for i, f in islice(rows, offset, None))
@@ -1,8 +1,12 @@
 #!/usr/bin/python3
 import tkinter as tk
 import sys
+import os
+import os.path
+from bisect import bisect_left
 from PlainTxtDB import DB, Tag
 from Food import *
+import FoodDiff
 
 class LabelEdit(object):
 	def __init__(self, parent, name, row=0, col=0, colspan=1):
@@ -106,7 +110,10 @@ class FoodView(tk.LabelFrame):
 		except: # sometimes it decides to deselect and the tuple[0] fails
 			self.foodlist.select(self.food)
 			return
-		self.food = self.foodlist.get_food(val)
+		self.show_food(self.foodlist.get_food(val))
+
+	def show_food(self, food):
+		self.food = food
 		self.config(text=self.food.name)
 		for e in self.entries:
 			e.set(self.food)
@@ -114,7 +121,16 @@ class FoodView(tk.LabelFrame):
 		self.insttxt.insert(tk.END, '\n'.join(self.food.instructions))
 		self.ingrtxt.delete('0.0', tk.END)
 		self.ingrtxt.insert(tk.END, self.food.ingredients_str())
-		
+
+	def refresh(self, names):
+		""" Show the current food again if it is one of \a names (that were reloaded) """
+		if not self.food or self.food.name not in names:
+			return
+		if self.food in self.foodlist.foods:
+			self.show_food(self.food)
+		else: # it was removed
+			self.food = None
+			self.config(text="Food")
 	
 	
 class FoodList(tk.Frame):
@@ -150,13 +166,28 @@ class FoodList(tk.Frame):
 	
 	def refresh_list(self):
 		self.all.delete(0, tk.END)
-		for f in Tag.filter(self.foods, self.filter_expr):
-			self.all.insert(tk.END, f.name)
-	
+		self.shown = [f.name for f in Tag.filter(self.foods, self.filter_expr)] # the names in the Listbox
+		for name in self.shown:
+			self.all.insert(tk.END, name)
+
+	def update_rows(self, names):
+		""" Redo only the rows of the foods \a names (that were added, changed or removed) """
+		order = {f.name: i for i, f in enumerate(self.foods)}
+		for name in names:
+			if name in self.shown:
+				idx = self.shown.index(name)
+				del self.shown[idx]
+				self.all.delete(idx)
+		for name in names:
+			if name in order and Tag.filter([self.foods[order[name]]], self.filter_expr):
+				idx = bisect_left([order[n] for n in self.shown], order[name])
+				self.shown.insert(idx, name)
+				self.all.insert(idx, name)
+
 	def select(self, afood):
-		idx = self.foods.index(afood)
 		self.all.selection_clear(0, tk.END)
-		self.all.selection_set(idx)
+		if afood is not None and str(afood) in self.shown:
+			self.all.selection_set(self.shown.index(str(afood)))
 
 	def get_food(self, foodstr):
 		try:
@@ -166,20 +197,64 @@ class FoodList(tk.Frame):
 
 
 class FoodBrowser(tk.PanedWindow): 
+	""" Watches the DB and brings in the snapshots other programs save (see poll) """
+	POLL_MS = 2000
+
 	def __init__(self, dbname, **kwargs):
 		tk.PanedWindow.__init__(self, None, **kwargs)
 		self.dbname = dbname
+		self.mtime = os.stat(dbname).st_mtime_ns
 		self.foods, self.name = DB.load(dbname)
+		FoodDiff.prime(dbname, os.path.basename(self.name), self.foods)
 		self.master.title(self.name)
 
 		self.foodlist = FoodList(self, self.foods)
 		self.add(self.foodlist)
-		self.add(FoodView(self, self.foodlist))
+		self.view = FoodView(self, self.foodlist)
+		self.add(self.view)
+		self.after(FoodBrowser.POLL_MS, self.poll)
 	
 	def save(self):
-		self.name = DB.save(self.foods, self.dbname)
+		self.name = DB.save(self.foods, self.dbname, base=self.name, merge=FoodDiff.merge)
+		FoodDiff.prime(self.dbname, os.path.basename(self.name), self.foods)
+		self.foodlist.refresh_list() # a merge may have brought in other foods
+		self.view.refresh([f.name for f in self.foods])
 		self.master.title(self.name)
-		
+
+	def poll(self):
+		"""
+		Reload if another program saved a snapshot.  A save changes the mtime of the DB directory,
+		so most polls are one stat() and the snapshot names are only listed after a change.
+		"""
+		try:
+			mtime = os.stat(self.dbname).st_mtime_ns
+			if mtime != self.mtime:
+				newest = DB.snapshot(self.dbname)
+				if newest != os.path.basename(self.name):
+					self.reload(newest)
+				self.mtime = mtime
+		except Exception as e:
+			print("Can't reload %s: %s"%(self.dbname, e))
+		finally:
+			self.after(FoodBrowser.POLL_MS, self.poll)
+
+	def reload(self, newest):
+		"""
+		Bring the snapshot \a newest into the foods being edited.  Only the foods that differ
+		from the snapshot we have are changed (see FoodDiff.update) and only their rows are redone.
+		Foods edited here are kept as they are, so saving them replaces the other version.
+		"""
+		old = FoodDiff.snapshot_records(self.dbname, os.path.basename(self.name))
+		new = FoodDiff.snapshot_records(self.dbname, newest)
+		updated, kept = FoodDiff.update(self.foods, old, new)
+		print("Reloaded %s: %d foods changed"%(newest, len(updated)))
+		if kept:
+			print("Kept the unsaved changes to %s.  Saving replaces the versions in %s"%(', '.join(sorted(kept)), newest))
+		self.name = os.path.join(self.dbname, newest)
+		self.foodlist.update_rows(updated)
+		self.view.refresh(updated)
+		self.master.title(self.name)
+
 
 if __name__ == '__main__':
 	# You can pass a database name if you want
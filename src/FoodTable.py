@@ -0,0 +1,234 @@
+"""
+A food DB stored one record per food, instead of one YAML graph held together by &id anchors.
+
+A FoodTable is a list of Foods.  When the DB saves it, the snapshot only holds
+
+	!FoodTable {file: foods/<snapshot>.yaml, count: N}
+
+and the foods are written next to it:
+  * foods/<snapshot>.yaml:  a YAML stream with one plain document per food.  An ingredient
+    is [food name, amount, unit, prep], so no document refers to another one.
+  * foods/<snapshot>.idx:  one line per food, 'offset length name', for finding a record
+    without reading the others.
+
+DB.load() reads every record and resolves the ingredient names.  FoodTable.load_partial()
+only reads the named recipes and the foods they use (transitively), and FoodTable.find()
+reads more of them when they are asked for.  Saving a partial table copies the records it
+never loaded straight from the old file, so nothing is lost, and every record keeps its
+place in the file.
+
+Convert a DB with FoodCMD.py:  'format table save' or 'format yaml save'.
+"""
+import os
+import os.path
+import yaml
+from PlainTxtDB import DB
+from Instrument import Instrument
+from Food import Food, Ingredient
+
+LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def to_record(food):
+	""" The plain dict stored for \a food """
+	rec = food.__getstate__()
+	rec['ingredients'] = [[str(i.food), i.amount, i.unit, i.prep] for i in food.ingredients]
+	return rec
+
+
+def from_records(records, known=None):
+	""" Foods from \a records.  Every ingredient must be one of them or in \a known {name: Food}. """
+	foods = []
+	byname = dict(known or {})
+	ingredients = []
+	for rec in records:
+		rec = dict(rec)
+		ingredients.append(rec.pop('ingredients', []))
+		f = Food.__new__(Food)
+		f.__setstate__(rec)
+		foods.append(f)
+		byname[f.name] = f
+	for f, ings in zip(foods, ingredients):
+		try:
+			f.ingredients = [Ingredient(food=byname[n], amount=a, unit=u, prep=p) for n, a, u, p in ings]
+		except KeyError as e:
+			raise Exception("%s uses the unknown food %s"%(f.name, e))
+	return foods
+
+
+class FoodTable(yaml.YAMLObject, list):
+	yaml_tag = '!FoodTable'
+	DIR = 'foods'
+
+	def __init__(self, foods=()):
+		list.__init__(self, foods)
+		self.file = None # The record file, relative to the DB directory
+		self.root = None # The DB directory
+		self.loaded = None # The names that were read by a partial load (None: all of them)
+
+	def __getstate__(self):
+		return {'file': self.file, 'count': len(self)}
+
+	def __setstate__(self, state):
+		self.__init__()
+		self.file = state['file']
+
+	@staticmethod
+	def index_file(filename):
+		return filename[:-len('.yaml')] + '.idx'
+
+	@staticmethod
+	def read_index(root, filename):
+		""" {name: (offset, length)} of the records in \a filename """
+		index = {}
+		with open(os.path.join(root, FoodTable.index_file(filename)), encoding='utf-8') as f:
+			for line in f:
+				offset, length, name = line.rstrip('\n').split(' ', 2)
+				index[name] = (int(offset), int(length))
+		return index
+
+	@staticmethod
+	def read_some(root, filename, index, names, skip=()):
+		"""
+		The records of \a names and of the foods their recipes use, but not the ones in \a skip,
+		from \a filename with the \a index {name: (offset, length)}.  Returns (records, names read).
+		"""
+		records = []
+		todo = [n for n in names if n not in skip]
+		seen = set(skip) | set(todo)
+		with open(os.path.join(root, filename), 'rb') as f:
+			while todo:
+				name = todo.pop()
+				if name not in index:
+					raise Exception("There is no food '%s' in %s"%(name, filename))
+				offset, length = index[name]
+				f.seek(offset)
+				rec = yaml.load(f.read(length), Loader=LOADER)
+				records.append(rec)
+				for i in rec.get('ingredients', []):
+					if i[0] not in seen:
+						seen.add(i[0])
+						todo.append(i[0])
+		# Keep the order of the file
+		records.sort(key=lambda r: index[r['name']][0])
+		return (records, seen - set(skip))
+
+	@staticmethod
+	def read_records(root, filename):
+		""" Every record in \a filename as a plain dict """
+		with open(os.path.join(root, filename), 'rb') as f, Instrument.timer('yaml.load'):
+			return [rec for rec in yaml.load_all(f, Loader=LOADER) if rec]
+
+	def db_save(self, path, name):
+		""" Called by DB.save.  Write the records of the snapshot \a name and return their files (see DB._save) """
+		filename = os.path.join(FoodTable.DIR, name[:-len('.yaml')] + '.yaml')
+		self._undo = (self.file, self.root, self.loaded, [os.path.join(path, f) for f in (filename, FoodTable.index_file(filename))])
+		os.makedirs(os.path.join(path, FoodTable.DIR), exist_ok=True)
+		keep = []
+		entries = list(self)
+		if self.loaded is not None:
+			# A partial table:  the records we never read are copied as they are.
+			# Foods that were read and are gone now were deleted.
+			here = set(f.name for f in self)
+			old = FoodTable.read_index(self.root, self.file)
+			clash = sorted(n for n in here - self.loaded if n in old)
+			if clash:
+				# A food made without reading the one in the file (see find()) would replace it
+				raise Exception("%s already in the database but weren't loaded"%', '.join(clash))
+			keep = [(n, old[n]) for n in old if n not in self.loaded and n not in here]
+			deleted = self.loaded - here
+			if deleted:
+				self._check_unused(deleted, keep)
+			# Every record stays where it was in the file (so list and its pages don't change) and new foods go last
+			kept = dict(keep)
+			byname = {f.name: f for f in self}
+			entries = [(n,) + kept[n] if n in kept else byname[n] for n in old if n in kept or n in byname] + \
+				[f for f in self if f.name not in old]
+		lines = []
+		with open(os.path.join(path, filename), 'wb') as out, Instrument.timer('yaml.dump'):
+			src = open(os.path.join(self.root, self.file), 'rb') if keep else None
+			try:
+				for e in entries:
+					if isinstance(e, tuple):
+						name, offset, length = e
+						src.seek(offset)
+						data = src.read(length)
+					else:
+						name = e.name
+						data = yaml.dump(to_record(e), Dumper=DUMPER, explicit_start=True, allow_unicode=True, sort_keys=False, default_flow_style=None).encode('utf-8')
+					lines.append('%d %d %s\n'%(out.tell(), len(data), name))
+					out.write(data)
+			finally:
+				if src:
+					src.close()
+			out.flush()
+			os.fsync(out.fileno())
+		with open(os.path.join(path, FoodTable.index_file(filename)), 'w', encoding='utf-8') as f:
+			f.writelines(lines)
+			f.flush()
+			os.fsync(f.fileno())
+		self.file = filename
+		self.root = path
+		if self.loaded is not None:
+			self.loaded = here | set(n for n, o in keep)
+		return [(filename, None), (FoodTable.index_file(filename), None)]
+
+	def db_abort(self, path, name):
+		""" Called by DB.save when the snapshot \a name couldn't be written after db_save().  Delete the records it wrote. """
+		self.file, self.root, self.loaded, written = self._undo
+		for filename in written:
+			if os.path.exists(filename):
+				os.remove(filename)
+
+	def find(self, name):
+		"""
+		The food \a name, or None if there is no such food.  A partial table that hasn't
+		read it yet reads it (and the foods it uses) now, so a food is never mistaken for a new one.
+		"""
+		if name in self:
+			return self[self.index(name)]
+		if self.loaded is None or name in self.loaded:
+			return None
+		index = FoodTable.read_index(self.root, self.file)
+		if name not in index:
+			return None
+		records, names = FoodTable.read_some(self.root, self.file, index, [name], skip=self.loaded)
+		self.extend(from_records(records, known={f.name: f for f in self}))
+		self.loaded |= names
+		Instrument.count('loaded.Food', len(records))
+		return self[self.index(name)]
+
+	def _check_unused(self, names, keep):
+		""" Make sure no record in \a keep (that we didn't load) uses one of the deleted foods \a names """
+		with open(os.path.join(self.root, self.file), 'rb') as src:
+			for n, (offset, length) in keep:
+				src.seek(offset)
+				for i in yaml.load(src.read(length), Loader=LOADER).get('ingredients', []):
+					if i[0] in names:
+						raise Exception("'%s' is used as an ingredient of %s.  It cannot be deleted"%(i[0], n))
+
+	def db_load(self, path):
+		""" Called by DB.load.  Read every record. """
+		self.root = path
+		self.extend(from_records(FoodTable.read_records(path, self.file)))
+		Instrument.count('loaded.Food', len(self))
+
+	@classmethod
+	def load_partial(self, path, names, snapshot=None):
+		"""
+		Load only the foods \a names and the foods their recipes use from a snapshot of the DB
+		at \a path (the newest one, or see DB.snapshot() for how to name one).
+		Returns (FoodTable, snapshot file name) like DB.load().
+		"""
+		snapshot = os.path.join(path, DB.snapshot(path, snapshot))
+		print("Loading %s (%s)"%(snapshot, ', '.join(names)))
+		with open(snapshot, encoding='utf-8') as f:
+			table = yaml.load(f, Loader=yaml.Loader)
+		if not isinstance(table, FoodTable):
+			raise Exception("%s is not a FoodTable.  Convert it with 'FoodCMD.py format table save'"%snapshot)
+		table.root = path
+		records, table.loaded = FoodTable.read_some(path, table.file, FoodTable.read_index(path, table.file), names)
+		table.extend(from_records(records))
+		Instrument.count('loaded.Food', len(table))
+		return (table, snapshot)
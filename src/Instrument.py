@@ -0,0 +1,162 @@
+"""
+Optional timing and profiling.  It costs next to nothing when it is off.
+
+Turn it on from the command line of FoodCMD.py:
+
+	./FoodCMD.py --profile list                # JSON report on stderr
+	./FoodCMD.py --profile=run.json --cprofile=20 --tracemalloc=10 list
+
+or with environment variables (for scripts that can't change the command line):
+
+	ORG_PROFILE=run.json  ORG_PROFILE_CPROFILE=20  ORG_PROFILE_TRACEMALLOC=10
+
+The report has the wall time and number of calls of every timer (commands, YAML
+parse and dump, fsync), counters (objects loaded and saved by type) and, if asked
+for, the top cProfile functions and tracemalloc allocation sites.
+"""
+import os
+import sys
+import io
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+class Instrument(object):
+	enabled = False
+	output = '-' # file name or '-' for stderr
+	started = None
+	timers = {} # name -> [calls, seconds]
+	counts = {} # name -> count
+	profiler = None
+	cprofile_top = 0
+	tracemalloc_top = 0
+
+	@classmethod
+	def start(self, output='-', cprofile_top=0, tracemalloc_top=0):
+		self.enabled = True
+		self.output = output or '-'
+		self.started = time.perf_counter()
+		self.timers = {}
+		self.counts = {}
+		self.cprofile_top = cprofile_top
+		self.tracemalloc_top = tracemalloc_top
+		if cprofile_top:
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		if tracemalloc_top:
+			import tracemalloc
+			tracemalloc.start()
+
+	@classmethod
+	def from_argv(self, argv):
+		""" Remove the profiling options from \a argv, start profiling if asked, and return the rest """
+		opts = {}
+		rest = []
+		for arg in argv:
+			name, _, value = arg.partition('=')
+			if name in ['--profile', '--cprofile', '--tracemalloc']:
+				opts[name] = value
+			else:
+				rest.append(arg)
+		env = os.environ
+		if opts or env.get('ORG_PROFILE'):
+			self.start(opts.get('--profile') or env.get('ORG_PROFILE', '-'),
+				int(opts.get('--cprofile') or env.get('ORG_PROFILE_CPROFILE') or (20 if '--cprofile' in opts else 0)),
+				int(opts.get('--tracemalloc') or env.get('ORG_PROFILE_TRACEMALLOC') or (10 if '--tracemalloc' in opts else 0)))
+		return rest
+
+	@classmethod
+	def timer(self, name):
+		""" A context manager that adds its wall time to the timer \a name """
+		if not self.enabled:
+			return nullcontext()
+		return self._timer(name)
+
+	@classmethod
+	@contextmanager
+	def _timer(self, name):
+		t = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - t)
+
+	@classmethod
+	def add(self, name, seconds):
+		""" Add \a seconds that were measured some other way to the timer \a name """
+		if self.enabled:
+			stat = self.timers.setdefault(name, [0, 0.0])
+			stat[0] += 1
+			stat[1] += seconds
+
+	@classmethod
+	def count(self, name, n=1):
+		if self.enabled:
+			self.counts[name] = self.counts.get(name, 0) + n
+
+	@classmethod
+	def count_objects(self, obj, prefix):
+		""" Count the objects reachable from \a obj by type as '<prefix>.<TypeName>' """
+		if not self.enabled:
+			return
+		seen = set()
+		stack = [obj]
+		while stack:
+			o = stack.pop()
+			if id(o) in seen:
+				continue
+			seen.add(id(o))
+			if isinstance(o, (list, tuple, set, frozenset)):
+				stack.extend(o)
+			elif isinstance(o, dict):
+				stack.extend(o.values())
+			elif hasattr(o, '__dict__'):
+				self.count('%s.%s'%(prefix, type(o).__name__))
+				stack.extend(o.__dict__.values())
+			elif getattr(type(o), '__slots__', None):
+				self.count('%s.%s'%(prefix, type(o).__name__))
+				stack.extend(getattr(o, k) for k in type(o).__slots__ if hasattr(o, k))
+
+	@classmethod
+	def report(self):
+		out = {
+			'argv': sys.argv,
+			'time': datetime.utcnow().isoformat(),
+			'wall': time.perf_counter() - self.started,
+			'timers': {k: {'calls': v[0], 'seconds': v[1]} for k, v in sorted(self.timers.items())},
+			'counts': dict(sorted(self.counts.items())),
+		}
+		if self.profiler:
+			import pstats
+			self.profiler.disable()
+			stats = pstats.Stats(self.profiler, stream=io.StringIO())
+			rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:self.cprofile_top]
+			out['cprofile'] = [{'function': '%s:%d(%s)'%func, 'calls': st[1], 'tottime': st[2], 'cumtime': st[3]} for func, st in rows]
+		if self.tracemalloc_top:
+			import tracemalloc
+			snapshot = tracemalloc.take_snapshot()
+			current, peak = tracemalloc.get_traced_memory()
+			out['tracemalloc'] = {
+				'current': current,
+				'peak': peak,
+				'top': [{'where': str(s.traceback[0]), 'size': s.size, 'count': s.count} for s in snapshot.statistics('lineno')[:self.tracemalloc_top]],
+			}
+			tracemalloc.stop()
+		return out
+
+	@classmethod
+	def stop(self):
+		""" Write the JSON report and turn instrumentation off """
+		if not self.enabled:
+			return
+		text = json.dumps(self.report(), indent=1)
+		if self.output == '-':
+			sys.stderr.write(text + '\n')
+		else:
+			with open(self.output, 'w', encoding='utf-8') as f:
+				f.write(text + '\n')
+		self.enabled = False
+		self.profiler = None
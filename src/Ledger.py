@@ -0,0 +1,242 @@
+"""
+The balance of a Repo at some time is its opening amount (Repo.amt) plus every
+Transfer into it and minus every Transfer out of it up to that time.
+
+Replaying the whole history for every question is slow, so the Ledger keeps the
+transfers sorted by time and, every CHECKPOINT transfers, a snapshot of the running
+totals of every repo.  A balance is then a bisect to find the time, a lookup in the
+checkpoint before it and a replay of at most CHECKPOINT transfers.
+
+All the amounts are integers so the sums are exact.  Times are seconds since EPOCH
+(to_epoch() and from_epoch() are here so Money and Report can share them).
+
+On disk the transfers live in a LedgerStore, partitioned by month, so that saving
+a new Transfer doesn't rewrite the whole history.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+import os
+import os.path
+import yaml
+
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch(when):
+	""" Seconds since the epoch of the (naive, UTC) datetime \a when """
+	return (when - EPOCH).total_seconds()
+
+def from_epoch(secs):
+	return EPOCH + timedelta(seconds=secs)
+
+def parse_when(text):
+	""" Parse an ISO 8601 time or a number of epoch seconds into a naive UTC datetime """
+	text = text.strip()
+	if text.isdigit():
+		return from_epoch(int(text))
+	when = datetime.fromisoformat(text)
+	if when.tzinfo:
+		when = when.astimezone(timezone.utc).replace(tzinfo=None)
+	return when
+
+
+class Ledger(object):
+	CHECKPOINT = 256 # Transfers between checkpoints
+
+	def __init__(self, transfers=()):
+		self.transfers = [] # Sorted by timestamp.  Equal times keep the order they were added in.
+		self.times = [] # epoch seconds of each transfer (for bisect)
+		self.checkpoints = [] # checkpoints[c] is {repo: total change} after the first (c+1)*CHECKPOINT transfers
+		for t in sorted(transfers, key=Ledger.epoch):
+			self.append(t)
+
+	@staticmethod
+	def epoch(transfer):
+		return to_epoch(transfer.timestamp)
+
+	@staticmethod
+	def changes(transfer):
+		""" The (repo, amount) changes that \a transfer makes """
+		for repo, amt in ((transfer.from_repo, -transfer.from_amt), (transfer.to_repo, transfer.to_amt)):
+			if not isinstance(amt, int):
+				raise Exception("Transfer amounts must be integers (%r)"%transfer)
+			if repo is not None and amt:
+				yield (repo, amt)
+
+	def __len__(self):
+		return len(self.transfers)
+
+	def append(self, transfer):
+		""" Add \a transfer.  Back-dated transfers are allowed; the checkpoints after them are rebuilt when next needed. """
+		t = Ledger.epoch(transfer)
+		list(Ledger.changes(transfer)) # validate before changing anything
+		i = bisect_right(self.times, t)
+		self.times.insert(i, t)
+		self.transfers.insert(i, transfer)
+		self._invalidate(i)
+
+	def remove(self, transfer):
+		i = self.transfers.index(transfer)
+		del self.times[i]
+		del self.transfers[i]
+		self._invalidate(i)
+
+	def _invalidate(self, i):
+		""" Forget the checkpoints that include the transfer at index \a i """
+		del self.checkpoints[i // Ledger.CHECKPOINT:]
+
+	def _checkpoint(self, c):
+		""" Running totals after the first c*CHECKPOINT transfers, building checkpoints as needed """
+		if c == 0:
+			return {}
+		while len(self.checkpoints) < c:
+			n = len(self.checkpoints)
+			totals = dict(self.checkpoints[-1]) if n else {}
+			for tr in self.transfers[n*Ledger.CHECKPOINT:(n+1)*Ledger.CHECKPOINT]:
+				for repo, amt in Ledger.changes(tr):
+					totals[repo] = totals.get(repo, 0) + amt
+			self.checkpoints.append(totals)
+		return self.checkpoints[c-1]
+
+	def change(self, repo, when):
+		""" The total change of \a repo from all the transfers at or before \a when """
+		i = bisect_right(self.times, to_epoch(when))
+		c = i // Ledger.CHECKPOINT
+		total = self._checkpoint(c).get(repo, 0)
+		for tr in self.transfers[c*Ledger.CHECKPOINT:i]:
+			for r, amt in Ledger.changes(tr):
+				if r is repo:
+					total += amt
+		return total
+
+	def balance(self, repo, when):
+		""" The integer amount in \a repo at \a when """
+		return repo.amt + self.change(repo, when)
+
+	def balances(self, repo, times):
+		""" balance() at each of the sorted epoch second \a times.  Returns a list of ints. """
+		out = []
+		if not times:
+			return out
+		i = bisect_right(self.times, times[0])
+		c = i // Ledger.CHECKPOINT
+		total = repo.amt + self._checkpoint(c).get(repo, 0)
+		i = c * Ledger.CHECKPOINT
+		for t in times:
+			end = bisect_right(self.times, t, i)
+			if end - i > Ledger.CHECKPOINT: # jump ahead with a checkpoint
+				c = end // Ledger.CHECKPOINT
+				total = repo.amt + self._checkpoint(c).get(repo, 0)
+				i = c * Ledger.CHECKPOINT
+			# walk forward through the transfers up to t
+			for tr in self.transfers[i:end]:
+				for r, amt in Ledger.changes(tr):
+					if r is repo:
+						total += amt
+			i = end
+			out.append(total)
+		return out
+
+
+class LedgerStore(object):
+	"""
+	Transfer records stored by month in append-only files:  <db>/ledger/2017-04.yaml
+	Each record is one YAML mapping appended as a new sequence item.
+	
+	A month can have several segments.  A segment is only appended to while its month is
+	current; once a save happens after the month is over it is sealed and never written again.
+	A back-dated transfer for a sealed month starts a new segment (2017-04.1.yaml).
+	
+	The snapshot keeps the size of every segment (see \a partitions) and only that many
+	bytes are ever read, so an older snapshot still sees exactly the transfers it had.
+	"""
+	DIR = 'ledger'
+	MONTH = '%Y-%m'
+	LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+	def __init__(self, root, partitions=None):
+		self.root = root
+		# {month: [{'file':..., 'count':..., 'size':..., 'sealed':...}, ...]}
+		self.partitions = {m: [dict(seg) for seg in segs] for m, segs in (partitions or {}).items()}
+
+	@staticmethod
+	def month(when):
+		return when.strftime(LedgerStore.MONTH)
+
+	def path(self, seg):
+		return os.path.join(self.root, LedgerStore.DIR, seg['file'])
+
+	def count(self):
+		""" The number of records stored """
+		return sum(seg['count'] for segs in self.partitions.values() for seg in segs)
+
+	def sealed(self, month):
+		""" Can transfers still be appended to the current segment of \a month? """
+		segs = self.partitions.get(month)
+		return bool(segs) and segs[-1]['sealed']
+
+	def months(self, start=None, end=None):
+		""" The months with records that overlap [\a start, \a end] """
+		first = LedgerStore.month(start) if start else None
+		last = LedgerStore.month(end) if end else None
+		return [m for m in sorted(self.partitions) if (not first or m >= first) and (not last or m <= last)]
+
+	def read(self, start=None, end=None):
+		""" The records between \a start and \a end (inclusive).  Only the partitions that overlap are opened. """
+		records = []
+		for m in self.months(start, end):
+			for seg in self.partitions[m]:
+				with open(self.path(seg), 'rb') as f:
+					data = f.read(seg['size'])
+				for rec in yaml.load(data, Loader=LedgerStore.LOADER) or []:
+					if (not start or rec['timestamp'] >= start) and (not end or rec['timestamp'] <= end):
+						records.append(rec)
+		records.sort(key=lambda r: r['timestamp'])
+		return records
+
+	def append(self, records):
+		""" Append \a records (dicts with a 'timestamp') to their month's partition.  See rollback(). """
+		self._undo = ({m: [dict(seg) for seg in segs] for m, segs in self.partitions.items()}, [])
+		bymonth = {}
+		for rec in records:
+			bymonth.setdefault(LedgerStore.month(rec['timestamp']), []).append(rec)
+		os.makedirs(os.path.join(self.root, LedgerStore.DIR), exist_ok=True)
+		for m, recs in sorted(bymonth.items()):
+			segs = self.partitions.setdefault(m, [])
+			seg = segs[-1] if segs else None
+			if not seg or seg['sealed'] or os.path.getsize(self.path(seg)) != seg['size']:
+				# Start a new segment.  Someone else may have written past our end of the old one.
+				n = len(segs)
+				while os.path.exists(os.path.join(self.root, LedgerStore.DIR, '%s%s.yaml'%(m, '.%d'%n if n else ''))):
+					n += 1
+				seg = {'file': '%s%s.yaml'%(m, '.%d'%n if n else ''), 'count': 0, 'size': 0, 'sealed': False}
+				segs.append(seg)
+			data = ''.join(['- ' + yaml.safe_dump(r, default_flow_style=True, width=float('inf')) for r in recs]).encode('utf-8')
+			self._undo[1].append((self.path(seg), os.path.getsize(self.path(seg)) if seg['size'] else None))
+			with open(self.path(seg), 'ab') as f:
+				f.write(data)
+				f.flush()
+				os.fsync(f.fileno())
+			seg['count'] += len(recs)
+			seg['size'] += len(data)
+		self.seal()
+
+	def rollback(self):
+		""" Undo the last append() (the snapshot that would use it couldn't be saved):
+		cut the segments back to where they were and delete the new ones.
+		"""
+		partitions, files = self._undo
+		for filename, size in reversed(files):
+			if size is None:
+				if os.path.exists(filename):
+					os.remove(filename)
+			else:
+				os.truncate(filename, size)
+		self.partitions = partitions
+
+	def seal(self):
+		""" Seal the segments of every month that is over """
+		current = LedgerStore.month(datetime.utcnow())
+		for m, segs in self.partitions.items():
+			if m < current:
+				segs[-1]['sealed'] = True
@@ -64,13 +64,25 @@
         on the two tradeables.
 """
 
+import yaml
 from datetime import datetime
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+import csv
+import heapq
+import mmap
+import struct
+import sys
 import os
 import os.path
 import time
 from PlainTxtDB import DB, YAMLSetter
+from Ledger import Ledger, LedgerStore, EPOCH, to_epoch, from_epoch, parse_when
+from Report import TransferColumns
 
-class ValueUnit(yaml.YAMLObject, YAMLSetter):
+
+class ValueUnit(YAMLSetter):
 	"""
 	A ValueUnits is something that has value.
 	  * US Dollars
@@ -86,7 +98,7 @@ class ValueUnit(yaml.YAMLObject, YAMLSetter):
 	So land in Texas is not the same as land in Tokyo
 	
 	Examples:
-	    ValueUnit(short='JPY', long='Japanese Yen', symbol='', type=['currency'], frac_digits=0)
+	    ValueUnit(short='JPY', long='Japanese Yen', symbol='¥', type=['currency'], frac_digits=0)
 	    ValueUnit(short='Decker', long='Decker Land', symbol='', type=['land', 'real estate'], frac_digits=6)
 	
 	"""	
@@ -100,7 +112,7 @@ class ValueUnit(yaml.YAMLObject, YAMLSetter):
 		}
 	
 	def __init__(self, **kwargs):
-		YAMLSetter.__intt__(self, kwargs)
+		YAMLSetter.__init__(self, kwargs)
 	
 	def to_float(self, quantity):
 		return quantity * (10**-self.frac_digits)		
@@ -112,7 +124,206 @@ class ValueUnit(yaml.YAMLObject, YAMLSetter):
 		return self.short == str(other)
 
 
-class Market(yaml.YAMLObject, YAMLSetter):
+class PriceHistory(yaml.YAMLObject):
+	"""
+	The assessments of a Market kept as three parallel columns:
+	  * when: epoch seconds (int64)
+	  * amtA: amount of unitA (float64)
+	  * amtB: amount of unitB (float64)
+	
+	On disk it is a 16 byte header followed by the raw columns, so the file
+	can be memory-mapped and nothing is read until the columns are first used.
+	The YAML snapshot only holds the name of the file.  Files are never
+	rewritten; a changed history is saved to a new file with the next snapshot.
+	"""
+	yaml_tag = '!PriceHistory'
+	MAGIC = b'PRICES'
+	HEADER = struct.Struct('<6s2sQ') # magic, byteorder ('le' or 'be'), count
+	TYPES = ('q', 'd', 'd')
+	
+	def __init__(self, points=()):
+		self.file = None # Name of the binary file, relative to the DB directory
+		self.root = None # The DB directory
+		self.dirty = False
+		self.version = 0 # Bumped on every change so cached conversions can tell they are stale
+		self._cols = tuple(array(t) for t in PriceHistory.TYPES)
+		self._map = None
+		for when, a, b in points:
+			self.insert(when, a, b)
+	
+	def __getstate__(self):
+		if self.file and not self.dirty:
+			return {'file': self.file, 'count': len(self)}
+		return {'points': list(self)} # Not saved by the DB so keep the data inline
+	
+	def __setstate__(self, state):
+		self.__init__(state.get('points', ()))
+		if 'file' in state:
+			self.file = state['file']
+			self._cols = None # map it later
+	
+	def attach(self, root):
+		""" Tell the history which DB directory its file lives in """
+		self.root = root
+	
+	def columns(self):
+		""" Return the (when, amtA, amtB) columns.  The file is mapped on the first call. """
+		if self._cols is None:
+			self._cols = self._open()
+		return self._cols
+	
+	def _open(self):
+		if not self.root:
+			raise Exception("Price history %s is not attached to a DB"%self.file)
+		with open(os.path.join(self.root, self.file), 'rb') as f:
+			self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, order, n = PriceHistory.HEADER.unpack_from(self._map)
+		if magic != PriceHistory.MAGIC:
+			raise Exception("%s is not a price history file"%self.file)
+		view = memoryview(self._map)
+		offset = PriceHistory.HEADER.size
+		cols = []
+		for t in PriceHistory.TYPES:
+			cols.append(view[offset:offset+8*n].cast(t))
+			offset += 8*n
+		view.release()
+		if order != PriceHistory.byteorder():
+			cols = self._copy(cols)
+			for c in cols:
+				c.byteswap()
+		return tuple(cols)
+	
+	@staticmethod
+	def byteorder():
+		return sys.byteorder[0].encode() + b'e'
+	
+	def _copy(self, cols):
+		""" Copy mapped columns into arrays and release the map """
+		out = []
+		for t, c in zip(PriceHistory.TYPES, cols):
+			a = array(t)
+			a.frombytes(c)
+			if isinstance(c, memoryview):
+				c.release()
+			out.append(a)
+		if self._map:
+			self._map.close()
+			self._map = None
+		return tuple(out)
+	
+	def _writable(self):
+		""" Columns that can be modified.  Mapped data is copied first. """
+		cols = self.columns()
+		if not isinstance(cols[0], array):
+			self._cols = cols = self._copy(cols)
+		self.dirty = True
+		self.version += 1
+		return cols
+	
+	def __len__(self):
+		return len(self.columns()[0])
+	
+	def __getitem__(self, i):
+		when, a, b = self.columns()
+		return (from_epoch(when[i]), a[i], b[i])
+	
+	def __iter__(self):
+		when, a, b = self.columns()
+		for i in range(len(when)):
+			yield (from_epoch(when[i]), a[i], b[i])
+	
+	def insert(self, when, amtA, amtB):
+		""" Add a single assessment in sorted order """
+		secs = int(to_epoch(when))
+		cols = self.columns()
+		i = bisect_left(cols[0], secs)
+		if i < len(cols[0]) and cols[0][i] == secs:
+			raise Exception("Cannot have two different assessments at the same time")
+		cols = self._writable()
+		for c, v in zip(cols, (secs, amtA, amtB)):
+			c.insert(i, v)
+	
+	def extend(self, whens, amtAs, amtBs):
+		""" Bulk append.  \a whens are epoch seconds in increasing order and must
+		all come after the last assessment.
+		"""
+		whens = array('q', whens)
+		amtAs = array('d', amtAs)
+		amtBs = array('d', amtBs)
+		if not (len(whens) == len(amtAs) == len(amtBs)):
+			raise Exception("Bulk data columns have different lengths")
+		if not whens:
+			return
+		times = self.columns()[0]
+		if len(times) and whens[0] <= times[-1]:
+			raise Exception("Bulk data must come after %s"%from_epoch(times[-1]))
+		if any(whens[i] >= whens[i+1] for i in range(len(whens)-1)):
+			raise Exception("Bulk data must be sorted")
+		cols = self._writable()
+		for c, v in zip(cols, (whens, amtAs, amtBs)):
+			c.extend(v)
+	
+	def merge(self, chunks):
+		"""
+		Merge \a chunks [(whens, amtAs, amtBs), ...] into the history in one pass.
+		Each chunk must be strictly increasing in time.  Assessments already in the
+		history win over new ones at the same time, then earlier chunks win over later ones.
+		Returns (added, duplicates, conflicts) where duplicates are the datetimes given
+		again with the same amounts and conflicts are (datetime, kept, rejected) tuples.
+		"""
+		chunks = [c for c in chunks if len(c[0])]
+		if not chunks:
+			return (0, [], [])
+		before = len(self)
+		cols = self._writable()
+		duplicates, conflicts = [], []
+		sources = ([cols] if before else []) + chunks
+		if all(sources[i][0][-1] < sources[i+1][0][0] for i in range(len(sources)-1)):
+			# Nothing overlaps (the usual case for sorted files) so just append
+			for src in chunks:
+				for c, v in zip(cols, src):
+					c.extend(v)
+			return (len(self) - before, duplicates, conflicts)
+		
+		def rows(rank, src):
+			whens, amtAs, amtBs = src
+			for i in range(len(whens)):
+				yield (whens[i], rank, amtAs[i], amtBs[i])
+		
+		out = tuple(array(t) for t in PriceHistory.TYPES)
+		last = None
+		for t, rank, a, b in heapq.merge(*[rows(r, src) for r, src in enumerate(sources)]):
+			if t == last:
+				kept = (out[1][-1], out[2][-1])
+				if kept == (a, b):
+					duplicates.append(from_epoch(t))
+				else:
+					conflicts.append((from_epoch(t), kept, (a, b)))
+				continue
+			out[0].append(t)
+			out[1].append(a)
+			out[2].append(b)
+			last = t
+		self._cols = out
+		return (len(self) - before, duplicates, conflicts)
+	
+	def save(self, root, filename):
+		""" Write the columns to \a filename inside the DB directory \a root """
+		cols = self.columns()
+		fullname = os.path.join(root, filename)
+		os.makedirs(os.path.dirname(fullname), exist_ok=True)
+		with open(fullname, 'wb') as f:
+			f.write(PriceHistory.HEADER.pack(PriceHistory.MAGIC, PriceHistory.byteorder(), len(cols[0])))
+			for c in cols:
+				f.write(c)
+			f.flush()
+			os.fsync(f.fileno())
+		self.file = filename
+		self.root = root
+		self.dirty = False
+
+
+class Market(YAMLSetter):
 	"""
 	Repositories only have value relative to other repositories.  
 	So you go to the market to get the value of a repo.
@@ -128,12 +339,19 @@ class Market(yaml.YAMLObject, YAMLSetter):
 	yaml_tag='!Market'
 	yaml_props = {
 		'unitA':None,
-		'unitb':None,
-		'points': [] #array of tuples (datetime, amt of unitA, amnt of unitB)
+		'unitB':None,
+		'points': None # PriceHistory of (datetime, amt of unitA, amnt of unitB)
 		}
 		
 	def __init__(self, **kwargs):
 		YAMLSetter.__init__(self, kwargs)
+		self.points = PriceHistory(self.points or ())
+	
+	def history(self):
+		""" The PriceHistory of this market.  Old snapshots stored a plain list of tuples. """
+		if not isinstance(self.points, PriceHistory):
+			self.points = PriceHistory(self.points or ())
+		return self.points
 		
 	def trade(self, value, unit, when=None):
 		""" 
@@ -155,22 +373,46 @@ class Market(yaml.YAMLObject, YAMLSetter):
 		"""
 		Get a converstion ratio (unitA/unitB) at \a time.  The default time is today.
 		"""
-		if len(self.points) == 0:
+		times, amtA, amtB = self.history().columns()
+		if len(times) == 0:
 			raise Exception("This market has no assesment data.")
 		if not when:
 			when = datetime.utcnow()
-		i = 0
-		while i < len(self.points) and when > self.points[i][0]:
-			i += 1
-		if i == len(self.points): # Asking about the future.  Use the latest known value
-			return self.points[-1][1] / self.points[-1][2]
+		t = to_epoch(when)
+		i = bisect_left(times, t)
+		if i == len(times): # Asking about the future.  Use the latest known value
+			return amtA[-1] / amtB[-1]
+		if times[i] == t:
+			return amtA[i] / amtB[i]
 		if i == 0: # Asking at a time before our first assessment
-			raise Exception("This market has no defined value before %s"%(str(self.points[0][0])))
+			raise Exception("This market has no defined value before %s"%(str(from_epoch(times[0]))))
 		# Linearly interpolate between the two points
-		dA = self.points[i][1] - self.points[i-1][1]
-		dB = self.points[i][2] - self.points[i-1][2]
-		frac = (when - self.points[i-1][0]).total_seconds() / (self.points[i][0] - self.points[i-1][0]).total_seconds()
-		return (self.points[i-1][1] + frac*dA) / (self.points[i-1][2] + frac*dB)
+		dA = amtA[i] - amtA[i-1]
+		dB = amtB[i] - amtB[i-1]
+		frac = (t - times[i-1]) / (times[i] - times[i-1])
+		return (amtA[i-1] + frac*dA) / (amtB[i-1] + frac*dB)
+	
+	def get_ratios(self, times):
+		"""
+		get_ratio() for many \a times (sorted epoch seconds) at once.
+		Returns an array('d').  Times before the first assessment are nan.
+		"""
+		whens, amtA, amtB = self.history().columns()
+		n = len(whens)
+		out = array('d')
+		i = 0
+		for t in times:
+			i = bisect_left(whens, t, i) # the times are sorted so never search backwards
+			if i == n:
+				out.append(amtA[-1] / amtB[-1] if n else float('nan'))
+			elif whens[i] == t:
+				out.append(amtA[i] / amtB[i])
+			elif i == 0:
+				out.append(float('nan'))
+			else:
+				frac = (t - whens[i-1]) / (whens[i] - whens[i-1])
+				out.append((amtA[i-1] + frac*(amtA[i] - amtA[i-1])) / (amtB[i-1] + frac*(amtB[i] - amtB[i-1])))
+		return out
 		
 	def assess(self, values, when=None):
 		""" 
@@ -179,16 +421,73 @@ class Market(yaml.YAMLObject, YAMLSetter):
 		"""
 		if not when:
 			when = datetime.utcnow()
-		# insert in sorted order
-		i = len(self.points)  # search backward to give O(n) for sorted data
-		while i > 0 and when < self.points[i-1][0]:
-			i -= 1
-		if i and self.points[i-1][0] == when:
-			raise Exception("Cannot have two different assessments at the same time")
-		self.points.insert(i, (when, values[str(self.unitA)], values[str(self.unitB)]))
+		self.history().insert(when, values[str(self.unitA)], values[str(self.unitB)])
+	
+	def import_csv(self, filename, when_column='when', chunk_size=100000):
+		"""
+		Bulk load assessments from the CSV file \a filename.  The header names the
+		columns the same way as the values of assess():  when,USD,JPY
+		Times are ISO 8601 (UTC unless an offset is given) or epoch seconds.
+		
+		The file is streamed.  Rows are validated and sorted \a chunk_size at a time
+		and all the chunks are merged into the history in a single pass.
+		Returns a report {'added', 'duplicates', 'conflicts', 'errors'}.
+		"""
+		report = {'added': 0, 'duplicates': [], 'conflicts': [], 'errors': []}
+		chunks = []
+		
+		def close_chunk(rows):
+			""" Sort the rows and pack them into columns, dropping repeated times """
+			rows.sort(key=itemgetter(0))
+			cols = tuple(array(t) for t in PriceHistory.TYPES)
+			for t, a, b in rows:
+				if len(cols[0]) and cols[0][-1] == t:
+					kept = (cols[1][-1], cols[2][-1])
+					if kept == (a, b):
+						report['duplicates'].append(from_epoch(t))
+					else:
+						report['conflicts'].append((from_epoch(t), kept, (a, b)))
+					continue
+				cols[0].append(t)
+				cols[1].append(a)
+				cols[2].append(b)
+			chunks.append(cols)
+		
+		with open(filename, newline='', encoding='utf-8') as f:
+			reader = csv.reader(f)
+			header = [h.strip() for h in next(reader, [])]
+			names = (when_column, str(self.unitA), str(self.unitB))
+			if not all(n in header for n in names):
+				raise Exception("%s needs the columns %s"%(filename, ', '.join(names)))
+			iw, ia, ib = [header.index(n) for n in names]
+			rows = []
+			for row in reader:
+				if not row:
+					continue
+				try:
+					t = int(to_epoch(parse_when(row[iw])))
+					a, b = float(row[ia]), float(row[ib])
+					if not (a > 0 and b > 0):
+						raise ValueError("amounts must be positive")
+				except (ValueError, IndexError) as e:
+					report['errors'].append((reader.line_num, str(e)))
+					continue
+				rows.append((t, a, b))
+				if len(rows) == chunk_size:
+					close_chunk(rows)
+					rows = []
+			close_chunk(rows)
+		
+		added, duplicates, conflicts = self.history().merge(chunks)
+		report['added'] = added
+		report['duplicates'] += duplicates
+		report['conflicts'] += conflicts
+		print("Imported %d assessments into %s/%s (%d duplicates, %d conflicts, %d errors)"%(
+			added, self.unitA, self.unitB, len(report['duplicates']), len(report['conflicts']), len(report['errors'])))
+		return report
 
 
-class Repo(yaml.YAMLObject, YAMLSetter):
+class Repo(YAMLSetter):
 	""" 
 	A Repo (Repository) is a place where 'value' is kept.  It has an integer quantity of 'stuff'.  
 	It is kept as an integer to avoid flotaing point imprecision and ensure exact math.
@@ -204,7 +503,7 @@ class Repo(yaml.YAMLObject, YAMLSetter):
 		'long':'', # A longer description name
 		'mine':True, # is this repository owned by me?
 		'unit':None, # A Value Unit
-		'amt':0, # integral amount of Unit
+		'amt':0, # integral amount of Unit before any Transfer (see FinanceSystem.balance)
 	}
 	
 	def __init__(self, **kwargs):
@@ -214,11 +513,12 @@ class Repo(yaml.YAMLObject, YAMLSetter):
 		""" Get the value of this repo from the \a market.
 		Since value changes with time you can specefy \a when.  It defaults to today.
 		"""
+		amt = self.unit.to_float(self.amt)
 		if not market:
-			return self.quantity
-		# use the market
+			return amt
+		return market.trade(amt, self.unit, when)
 
-class Transfer(yaml.YAMLObject, YAMLSetter):
+class Transfer(YAMLSetter):
 	""" Value moves from place to place.  It is neither created or destroyed (sort of).
 	There is possible friction at every transfer.
 	
@@ -235,6 +535,7 @@ class Transfer(yaml.YAMLObject, YAMLSetter):
 	"""
 	
 	yaml_tag = '!Transfer'
+	yaml_slots = True
 	yaml_props = {
 		'from_repo': None,  # The Repo that the transfer is coming from
 		'from_amt': 0, # The integral amount of stuff to take from from_repo
@@ -248,9 +549,59 @@ class Transfer(yaml.YAMLObject, YAMLSetter):
 	
 	def __init__(self, **kwargs):
 		YAMLSetter.__init__(self, kwargs)
+	
+	def has_tag(self, tagname):
+		""" tagname should be all caps (see Tag.match) """
+		return tagname in self.tags
 
 
-class FinanceSystem(yaml.YAMLObject, YAMLSetter):
+class TransferList(list):
+	"""
+	The transactions of a FinanceSystem.  A list that counts the changes other than appending
+	(\a edits), so whatever is built from it can tell when it only has to add the new tail.
+	"""
+	def __init__(self, transfers=()):
+		list.__init__(self, transfers)
+		self.edits = 0
+
+	def insert(self, i, transfer):
+		self.edits += 1
+		list.insert(self, i, transfer)
+
+	def remove(self, transfer):
+		self.edits += 1
+		list.remove(self, transfer)
+
+	def pop(self, i=-1):
+		self.edits += 1
+		return list.pop(self, i)
+
+	def clear(self):
+		self.edits += 1
+		list.clear(self)
+
+	def sort(self, **kwargs):
+		self.edits += 1
+		list.sort(self, **kwargs)
+
+	def reverse(self):
+		self.edits += 1
+		list.reverse(self)
+
+	def __setitem__(self, i, value):
+		self.edits += 1
+		list.__setitem__(self, i, value)
+
+	def __delitem__(self, i):
+		self.edits += 1
+		list.__delitem__(self, i)
+
+	def __imul__(self, n):
+		self.edits += 1
+		return list.__imul__(self, n)
+
+
+class FinanceSystem(YAMLSetter):
 	"""
 	This holds all the data needed to track your finances
 	"""
@@ -262,6 +613,326 @@ class FinanceSystem(yaml.YAMLObject, YAMLSetter):
 		'transactions':[]
 	}
 	
+	RATIO_CACHE = 10000 # The most conversion ratios kept (see conversion_ratio)
+	
 	def __init__(self, **kwargs):
 		YAMLSetter.__init__(self, kwargs)
-	
\ No newline at end of file
+		self.__dict__['transactions'] = TransferList(self.__dict__['transactions'])
+	
+	def __getstate__(self):
+		# Leave the caches out of the snapshot.
+		# Once the transfers are in a LedgerStore the snapshot only keeps the size of its partitions.
+		state = {k:v for k,v in self.__dict__.items() if not k.startswith('_')}
+		if getattr(self, '_store', None):
+			state.pop('transactions', None)
+			state['partitions'] = self._store.partitions
+		elif state.get('transactions') is not None:
+			state['transactions'] = list(state['transactions'])
+		return state
+	
+	@property
+	def transactions(self):
+		""" All the Transfers.  After DB.load they are only read from the ledger partitions when first needed. """
+		transfers = self.__dict__.get('transactions')
+		if transfers is None:
+			# The ledger partitions hold the first store.count() of them and the rest are unsaved
+			transfers = self._from_records(self._store.read()) + self.__dict__.pop('_unsaved', [])
+			transfers = self.__dict__['transactions'] = TransferList(transfers)
+			self._stored_of = (transfers, transfers.edits)
+		elif not isinstance(transfers, TransferList): # from an old snapshot
+			transfers = self.__dict__['transactions'] = TransferList(transfers)
+		return transfers
+	
+	@transactions.setter
+	def transactions(self, transfers):
+		self.__dict__['transactions'] = TransferList(transfers)
+	
+	def transfers(self, start=None, end=None):
+		""" The Transfers between \a start and \a end (inclusive) sorted by time.
+		If the transactions aren't loaded yet only the ledger partitions that overlap are read.
+		"""
+		def inside(t):
+			return (not start or t.timestamp >= start) and (not end or t.timestamp <= end)
+		if self.__dict__.get('transactions') is not None:
+			found = [t for t in self.transactions if inside(t)]
+		else:
+			found = self._from_records(self._store.read(start, end))
+			found += [t for t in self.__dict__.get('_unsaved', []) if inside(t)]
+		return sorted(found, key=lambda t: t.timestamp)
+	
+	def _to_record(self, t):
+		""" A Transfer as a plain dict for the LedgerStore.  Repos and markets are referenced by name. """
+		return {
+			'timestamp': t.timestamp,
+			'from': t.from_repo.name if t.from_repo else None,
+			'from_amt': t.from_amt,
+			'to': t.to_repo.name if t.to_repo else None,
+			'to_amt': t.to_amt,
+			'market': '%s/%s'%(t.market.unitA, t.market.unitB) if t.market else None,
+			'memo': t.memo,
+			'tags': list(t.tags),
+		}
+	
+	def _from_records(self, records):
+		repos = {r.name: r for r in self.repos}
+		markets = {'%s/%s'%(m.unitA, m.unitB): m for m in self.markets}
+		def lookup(table, name, what):
+			if name is None:
+				return None
+			if name not in table:
+				raise Exception("The ledger refers to an unknown %s '%s'"%(what, name))
+			return table[name]
+		return [Transfer(
+			timestamp=rec['timestamp'],
+			from_repo=lookup(repos, rec['from'], 'repo'),
+			from_amt=rec['from_amt'],
+			to_repo=lookup(repos, rec['to'], 'repo'),
+			to_amt=rec['to_amt'],
+			market=lookup(markets, rec['market'], 'market'),
+			memo=rec['memo'],
+			tags=rec['tags']) for rec in records]
+	
+	def _graph(self):
+		""" The markets as a graph {unit name: [(other unit name, market), ...]}.
+		It (and the caches built on it) is rebuilt when the list of markets changes.
+		"""
+		key = tuple(map(id, self.markets))
+		if getattr(self, '_graph_key', None) != key:
+			self._graph_key = key
+			self._edges = {}
+			for m in self.markets:
+				self._edges.setdefault(str(m.unitA), []).append((str(m.unitB), m))
+				self._edges.setdefault(str(m.unitB), []).append((str(m.unitA), m))
+			self._paths = {}
+			self._ratios = {}
+		return self._edges
+	
+	def conversion_path(self, from_unit, to_unit):
+		""" The shortest chain of markets from \a from_unit to \a to_unit
+		as a list of (market, unit given to that market).
+		"""
+		edges = self._graph()
+		key = (str(from_unit), str(to_unit))
+		if key not in self._paths:
+			# Breadth first search so we use the fewest trades
+			prev = {key[0]: None}
+			queue = [key[0]]
+			while queue and key[1] not in prev:
+				unit = queue.pop(0)
+				for other, m in edges.get(unit, []):
+					if other not in prev:
+						prev[other] = (unit, m)
+						queue.append(other)
+			if key[1] not in prev:
+				raise Exception("No markets connect %s to %s"%key)
+			path = []
+			unit = key[1]
+			while prev[unit]:
+				unit, m = prev[unit]
+				path.insert(0, (m, unit))
+			self._paths[key] = path
+		return self._paths[key]
+	
+	def conversion_ratio(self, from_unit, to_unit, when=None):
+		"""
+		How much \a to_unit one \a from_unit is worth at \a when (default now),
+		trading through as many markets as needed.  The path is only searched once and the
+		ratio at each time is cached until any market on the path gets a new assessment.
+		"""
+		path = self.conversion_path(from_unit, to_unit)
+		if not when:
+			when = datetime.utcnow()
+		key = (str(from_unit), str(to_unit), to_epoch(when))
+		versions = tuple(m.history().version for m, unit in path)
+		cached = self._ratios.get(key)
+		if cached and cached[0] == versions:
+			return cached[1]
+		ratio = 1.0
+		for m, unit in path:
+			ratio = m.trade(ratio, unit, when)
+		if len(self._ratios) >= FinanceSystem.RATIO_CACHE:
+			self._ratios.clear()
+		self._ratios[key] = (versions, ratio)
+		return ratio
+	
+	def convert(self, value, from_unit, to_unit, when=None):
+		""" Convert \a value of \a from_unit into \a to_unit.  See conversion_ratio() """
+		return value * self.conversion_ratio(from_unit, to_unit, when)
+	
+	def conversion_ratios(self, from_unit, to_unit, times):
+		""" conversion_ratio() for many sorted epoch second \a times at once.  Returns an array('d'). """
+		ratios = array('d', [1.0]) * len(times)
+		for m, unit in self.conversion_path(from_unit, to_unit):
+			r = m.get_ratios(times)
+			if unit == str(m.unitA):
+				ratios = array('d', [x/y for x, y in zip(ratios, r)])
+			else:
+				ratios = array('d', [x*y for x, y in zip(ratios, r)])
+		return ratios
+	
+	def ledger(self):
+		"""
+		The Ledger of the transactions.  Transfers appended to them since it was built are added
+		(a back-dated one only drops the checkpoints after it).  Any other change rebuilds it.
+		"""
+		transfers = self.transactions
+		built = getattr(self, '_ledger_of', None)
+		if getattr(self, '_ledger', None) is None or built[0] is not transfers or built[1] != transfers.edits:
+			self._ledger = Ledger(transfers)
+		else:
+			for t in transfers[len(self._ledger):]:
+				self._ledger.append(t)
+		self._ledger_of = (transfers, transfers.edits)
+		return self._ledger
+	
+	def add_transfer(self, transfer):
+		""" Record a new (possibly back-dated) Transfer.  It is appended to the ledger partitions on the next save. """
+		if self.__dict__.get('transactions') is not None:
+			self.transactions.append(transfer)
+		else:
+			self.__dict__.setdefault('_unsaved', []).append(transfer)
+	
+	def remove_transfer(self, transfer):
+		""" Take \a transfer out of the transactions.  The ledger only drops the checkpoints after it. """
+		transfers = self.transactions
+		ledger = self.ledger()
+		transfers.remove(transfer)
+		ledger.remove(transfer)
+		self._ledger_of = (transfers, transfers.edits)
+	
+	def balance(self, repo, when=None):
+		""" The integer amount in \a repo at \a when (default now).  Repo.amt is the opening balance. """
+		return self.ledger().balance(repo, when or datetime.utcnow())
+	
+	def columns(self):
+		""" A TransferColumns projection of the transactions.  Rebuilt when the transactions change. """
+		transfers = self.transactions
+		state = (transfers.edits, len(transfers))
+		built = getattr(self, '_columns_of', None)
+		if getattr(self, '_columns', None) is None or built[0] is not transfers or built[1] != state:
+			self._columns = TransferColumns(transfers)
+			self._columns_of = (transfers, state)
+		return self._columns
+	
+	def report(self, by='month', tagexpr='', start=None, end=None, unit=None):
+		"""
+		Sum the transfers grouped \a by month, tag, from_repo, to_repo or unit.  See TransferColumns.aggregate()
+		The sums are per unit, or converted to \a unit at the time of each transfer.
+		"""
+		ratios = None
+		if unit:
+			def ratios(from_unit, times):
+				step = from_unit.to_float(1)
+				return [step * r for r in self.conversion_ratios(from_unit, unit, times)]
+		return self.columns().aggregate(by, tagexpr, start, end, ratios)
+	
+	def _amounts(self, repo, times):
+		""" The quantity (as a float of repo.unit) held by \a repo at each of the epoch second \a times """
+		return array('d', [repo.unit.to_float(b) for b in self.ledger().balances(repo, times)])
+	
+	def valuation(self, unit, times, repos=None):
+		"""
+		Value every repo in \a repos (default: all the repos that are mine) in \a unit
+		at each of the sorted datetimes \a times.
+		Returns (repos, rows) where rows[i] is an array('d') with the value of repos[i]
+		at each time.  Market ratios are computed once per repo unit and shared.
+		Values that can't be known (before a market's first assessment, or of a unit
+		no markets connect to \a unit) are nan.
+		"""
+		if repos is None:
+			repos = [r for r in self.repos if r.mine]
+		secs = [to_epoch(t) for t in times]
+		if any(secs[i] > secs[i+1] for i in range(len(secs)-1)):
+			raise Exception("Valuation times must be sorted")
+		ratios = {}
+		rows = []
+		for r in repos:
+			if str(r.unit) not in ratios:
+				try:
+					self.conversion_path(r.unit, unit)
+				except Exception: # nothing to price it with (like land), so only this repo is unknown
+					ratios[str(r.unit)] = None
+				else:
+					ratios[str(r.unit)] = self.conversion_ratios(r.unit, unit, secs)
+			ratio = ratios[str(r.unit)]
+			if ratio is None:
+				rows.append(array('d', [float('nan')]) * len(secs))
+				continue
+			amounts = self._amounts(r, secs)
+			rows.append(array('d', [a*b for a, b in zip(amounts, ratio)]))
+		return (repos, rows)
+	
+	def net_worth(self, unit, times):
+		""" The total value of all my repos in \a unit at each of \a times (nan when one can't be known, see valuation()).  Returns an array('d'). """
+		repos, rows = self.valuation(unit, times)
+		total = array('d', [0.0]) * len(times)
+		for row in rows:
+			for i, v in enumerate(row):
+				total[i] += v
+		return total
+	
+	def db_save(self, path, name):
+		"""
+		Called by DB.save.  Write every changed market history next to the snapshot \a name
+		and append the new transfers.  Returns the side-car files the snapshot uses (see DB._save).
+		"""
+		undo = self._undo = {'histories': [], 'store': None, 'state': {}} # see db_abort()
+		for i, m in enumerate(self.markets):
+			h = m.history()
+			if h.dirty or not h.file or h.root != path:
+				filename = os.path.join('prices', '%s__%d.bin'%(name[:-len('.yaml')], i))
+				undo['histories'].append((h, filename, h.file, h.root, h.dirty))
+				h.save(path, filename)
+		# Append the new transfers to the ledger partitions.  They are all written to new segments
+		# when saving somewhere new or when the transactions were changed other than by appending.
+		store = getattr(self, '_store', None)
+		if store and store.root != path:
+			store = None
+		transfers = self.__dict__.get('transactions')
+		if transfers is None:
+			pending = self.__dict__.get('_unsaved', []) if store else self.transactions
+		else:
+			transfers = self.transactions
+			stored = getattr(self, '_stored_of', None)
+			if store and stored and stored[0] is transfers and stored[1] == transfers.edits:
+				pending = transfers[store.count():]
+			else:
+				pending = transfers
+				store = None
+		if not store:
+			store = LedgerStore(path)
+		undo['store'] = store
+		undo['state'] = {k: self.__dict__.get(k) for k in ['_store', '_unsaved', '_stored_of']}
+		store.append([self._to_record(t) for t in pending])
+		self._store = store
+		self._unsaved = []
+		if self.__dict__.get('transactions') is not None:
+			self._stored_of = (self.transactions, self.transactions.edits)
+		files = [(m.history().file, None) for m in self.markets]
+		files += [(os.path.join(LedgerStore.DIR, seg['file']), seg['size']) for segs in store.partitions.values() for seg in segs]
+		return files
+	
+	def db_abort(self, path, name):
+		""" Called by DB.save when the snapshot \a name couldn't be written after db_save().  Undo what db_save() wrote. """
+		undo = self.__dict__.pop('_undo', None)
+		if not undo:
+			return
+		for h, filename, file, root, dirty in undo['histories']:
+			if os.path.exists(os.path.join(path, filename)):
+				os.remove(os.path.join(path, filename))
+			h.file, h.root, h.dirty = file, root, dirty
+		if undo['store']:
+			undo['store'].rollback()
+		for k, v in undo['state'].items():
+			if v is None:
+				self.__dict__.pop(k, None)
+			else:
+				self.__dict__[k] = v
+	
+	def db_load(self, path):
+		""" Called by DB.load.  The histories are mapped and the transfers are read when they are first used. """
+		for m in self.markets:
+			m.history().attach(path)
+		if 'partitions' in self.__dict__:
+			self._store = LedgerStore(path, self.__dict__.pop('partitions'))
+			self.__dict__['transactions'] = None
@@ -9,8 +9,19 @@ This serves as an automatic backup system.
 """
 import yaml
 from datetime import datetime
+from contextlib import contextmanager
+import hashlib
+import pickle
+import time
 import os.path
 import os
+import sys
+from Instrument import Instrument
+try:
+	import fcntl
+except ImportError: # Windows
+	fcntl = None
+	import msvcrt
 
 
 class Tag(object):
@@ -108,53 +119,388 @@ class Tag(object):
 			return []
 		return [f for f in iterable if Tag.match(f, tagexpr)]
 
+	TAGSETS = {} # every distinct tuple of tags, so objects with the same tags share one tuple
+
+	@staticmethod
+	def intern(tags):
+		""" The shared tuple of the (interned) tag strings in \a tags """
+		tags = tuple(tags)
+		shared = Tag.TAGSETS.get(tags)
+		if shared is None:
+			shared = tuple(sys.intern(t) for t in tags)
+			Tag.TAGSETS[shared] = shared
+		return shared
+
+
+def _slots_getstate(self):
+	# Only the slots that are set (an old snapshot may not have them all).
+	# Tags are kept as shared tuples but written as lists (_slots_setstate interns them again).  Other tuples stay tuples.
+	state = {}
+	for k in self.yaml_props:
+		if hasattr(self, k):
+			v = getattr(self, k)
+			state[k] = list(v) if k == 'tags' else v
+	if self._extra:
+		state.update(self._extra)
+	return state
+
+
+def _slots_setstate(self, state):
+	self._extra = None
+	for k, v in state.items():
+		if k not in self.yaml_props:
+			# Properties we don't know (left by older code) are kept so they are saved again
+			if self._extra is None:
+				self._extra = {}
+			self._extra[k] = v
+		else:
+			setattr(self, k, Tag.intern(v) if k == 'tags' else v)
+
+
+class TagSet(frozenset):
+	""" A set of tag names that Tag.match() understands """
+	def has_tag(self, tagname):
+		return tagname in self
+
+
+class YAMLSetterMeta(yaml.YAMLObjectMetaclass):
+	""" A class with yaml_slots = True gets its __slots__ from its yaml_props """
+	def __new__(meta, name, bases, ns):
+		if ns.get('yaml_slots'):
+			ns['__slots__'] = tuple(ns['yaml_props']) + ('_extra',)
+			ns.setdefault('__getstate__', _slots_getstate)
+			ns.setdefault('__setstate__', _slots_setstate)
+		return super().__new__(meta, name, bases, ns)
+
+
+class YAMLSetter(yaml.YAMLObject, metaclass=YAMLSetterMeta):
+	"""
+	An object with the properties (and their defaults) listed in yaml_props.
+	With yaml_slots = True the properties are slots and there is no __dict__, which is
+	much smaller for objects there are millions of.  Tags are stored as shared tuples (see Tag.intern).
+	"""
+	__slots__ = ()
+	yaml_slots = False
 
-class YAMLSetter(yaml.YAMLObject):
 	def __init__(self, kwargs):
+		if self.yaml_slots:
+			self._extra = None
 		for k,v in self.__class__.yaml_props.items():
-			self.__dict__[k] = kwargs[k] if k in kwargs else v
+			if k in kwargs:
+				v = kwargs[k]
+			elif isinstance(v, list):
+				v = list(v) # don't share the default list
+			setattr(self, k, Tag.intern(v) if k == 'tags' else v)
 				
 	def __repr__(self):
-		return "%s(%s)"%(self.__class__.__name__, ', '.join(['%s=%r'%(k,getattr(self,k)) for k,v in self.__class__.yaml_props.items() if v != getattr(self,k)]))
+		return "%s(%s)"%(self.__class__.__name__, ', '.join(['%s=%r'%(k,getattr(self,k,v)) for k,v in self.__class__.yaml_props.items() if v != getattr(self,k,v)]))
+
+
+def file_digest(filename, blocksize=1<<20, size=None):
+	""" The sha256 of \a filename (or of its first \a size bytes), read a block at a time so memory stays flat """
+	h = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		left = size
+		while left is None or left > 0:
+			block = f.read(blocksize if left is None else min(blocksize, left))
+			if not block:
+				break
+			h.update(block)
+			if left is not None:
+				left -= len(block)
+	return h.hexdigest()
+
+
+def check_sidecars(sidecars):
+	""" The first of \a sidecars [(filename, size, sha256), ...] that doesn't match its checksum, or None """
+	for filename, size, digest in sidecars:
+		if file_digest(filename, size=size) != digest:
+			return filename
+	return None
+
+
+def verify_file(args):
+	""" Check one snapshot.  \a args is (filename, expected sha256 or None, [(side-car filename, size, sha256), ...]).
+	Returns (filename, status, message) where status is 'ok', 'corrupt' or 'unchecked'.
+	This runs in a worker process of DB.verify().
+	"""
+	filename, digest, sidecars = args
+	try:
+		if digest:
+			if file_digest(filename) != digest:
+				return (filename, 'corrupt', 'checksum mismatch')
+			bad = check_sidecars(sidecars)
+			if bad:
+				return (filename, 'corrupt', 'checksum mismatch in %s'%bad)
+			return (filename, 'ok', '')
+		# No checksum was recorded (an older snapshot) so at least make sure it parses.
+		# Only the YAML events are produced, no objects are built.
+		with open(filename, 'rb') as f:
+			for event in yaml.parse(f, Loader=getattr(yaml, 'CLoader', yaml.Loader)):
+				pass
+		return (filename, 'unchecked', 'no checksum but it parses')
+	except Exception as e:
+		return (filename, 'corrupt', str(e).replace('\n', ' '))
+
+
+class ConflictError(Exception):
+	""" The DB was saved by someone else since we loaded it and the changes can't be merged """
+	pass
 
 
 class DB(object):
 	FILENAME_FMT = "%Y-%m-%d__%H.%M.%S.yaml"
+	CHECKSUMS = 'SHA256SUMS' # in the format of sha256sum(1) so 'sha256sum -c SHA256SUMS' works too
+	SIDECARS = 'SIDECARS' # 'sha256  snapshot  size  file' of the side-car files each snapshot uses
+	CACHE_DIR = 'cache'
+	LOCK = 'lock'
+	
+	@classmethod
+	def snapshots(self, path):
+		""" Return the timestamps of all the snapshot files in \a path, newest first.
+		Anything else in the directory (the 'saving' file, side-car directories) is ignored.
+		"""
+		files = []
+		for s in os.listdir(path):
+			try:
+				files.append(datetime.strptime(s, DB.FILENAME_FMT))
+			except ValueError:
+				pass
+		return sorted(files, reverse=True)
+	
+	@classmethod
+	def checksums(self, path):
+		""" {snapshot name: sha256} of the snapshots that recorded one """
+		sums = {}
+		filename = os.path.join(path, DB.CHECKSUMS)
+		if os.path.exists(filename):
+			with open(filename, encoding='utf-8') as f:
+				for line in f:
+					digest, _, name = line.rstrip('\n').partition('  ')
+					if name:
+						sums[name] = digest
+		return sums
+	
+	@classmethod
+	def sidecars(self, path):
+		""" {snapshot name: [(side-car file relative to \a path, size, sha256), ...]}
+		The snapshot uses the first size bytes of the file (ledger segments keep growing).
+		"""
+		out = {}
+		filename = os.path.join(path, DB.SIDECARS)
+		if os.path.exists(filename):
+			with open(filename, encoding='utf-8') as f:
+				for line in f:
+					parts = line.rstrip('\n').split('  ', 3)
+					if len(parts) == 4:
+						digest, name, size, sidecar = parts
+						out.setdefault(name, []).append((sidecar, int(size), digest))
+		return out
 	
 	@classmethod
-	def load(self, path, when=None):
-		files = sorted(map(lambda s: datetime.strptime(s, DB.FILENAME_FMT), os.listdir(path)), reverse=True)
+	def load(self, path, when=None, fallback=False):
+		""" Load the newest snapshot at or before \a when (default: the newest one).
+		With \a fallback a snapshot that fails its checksum or doesn't parse is skipped
+		and the next older one is tried.
+		"""
+		files = self.snapshots(path)
 		if not files:
 			raise Exception("No database files at: %s"%path)
 		i = 0
-		while when and i < len(files) and when > files[i]:
+		while when and i < len(files) and files[i] > when:
 			i+=1
 		if i == len(files):
 			raise Exception("No database files before %s"%when.isoformat())
-		name = os.path.join(path, files[i].strftime(DB.FILENAME_FMT))
-		print("Loading %s"%name)
-		with open(name, encoding="utf-8") as f:
-			obj = yaml.load(f)
-		return (obj, name)
+		sums = self.checksums(path) if fallback else {}
+		sidecars = self.sidecars(path) if fallback else {}
+		for ts in (files[i:] if fallback else files[i:i+1]):
+			name = os.path.join(path, ts.strftime(DB.FILENAME_FMT))
+			print("Loading %s"%name)
+			try:
+				digest = sums.get(os.path.basename(name))
+				if digest and file_digest(name) != digest:
+					raise Exception("checksum mismatch")
+				bad = check_sidecars([(os.path.join(path, f), size, d) for f, size, d in sidecars.get(os.path.basename(name), [])])
+				if bad:
+					raise Exception("checksum mismatch in %s"%bad)
+				with open(name, encoding="utf-8") as f, Instrument.timer('yaml.load'):
+					obj = yaml.load(f, Loader=yaml.Loader)
+			except Exception as e:
+				if not fallback:
+					raise
+				print("%s is corrupt (%s).  Trying an older one."%(name, e))
+				continue
+			Instrument.count('bytes.loaded', os.path.getsize(name))
+			Instrument.count_objects(obj, 'loaded')
+			# Objects that keep data outside of the snapshot need to know where it is
+			if hasattr(obj, 'db_load'):
+				obj.db_load(path)
+			return (obj, name)
+		raise Exception("No good database files at: %s"%path)
+	
+	@classmethod
+	def snapshot(self, path, name=None):
+		""" The file name of a snapshot in \a path given its file name, a timestamp prefix ('2017-04-06', '2017')
+		or a negative index (-1 or '-1' is the newest, -2 the one before it).
+		"""
+		names = [ts.strftime(DB.FILENAME_FMT) for ts in self.snapshots(path)]
+		if name is None:
+			name = -1
+		if isinstance(name, int) or (name.startswith('-') and name[1:].isdigit()):
+			i = -int(name) - 1
+			if not 0 <= i < len(names):
+				raise Exception("There is no snapshot %s in %s"%(name, path))
+			return names[i]
+		matches = [n for n in names if n.startswith(os.path.basename(name))]
+		if not matches:
+			raise Exception("There is no snapshot %s in %s"%(name, path))
+		return matches[0]
+	
+	@classmethod
+	def cached(self, path, name, kind, compute):
+		""" Data derived from the snapshot \a name.  Snapshots never change so \a compute(filename)
+		is only called once per snapshot and \a kind;  the result is pickled in <db>/cache/.
+		"""
+		cachefile = os.path.join(path, DB.CACHE_DIR, '%s.%s.pickle'%(name[:-len('.yaml')], kind))
+		try:
+			with open(cachefile, 'rb') as f:
+				return pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			pass
+		value = compute(os.path.join(path, name))
+		os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+		tmp = '%s.%d'%(cachefile, os.getpid())
+		with open(tmp, 'wb') as f:
+			pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, cachefile)
+		return value
+	
+	@classmethod
+	def verify(self, path, workers=None):
+		""" Check every snapshot in \a path against its checksum, using a pool of \a workers processes.
+		Returns [(filename, status, message), ...] newest first.  See verify_file().
+		"""
+		sums = self.checksums(path)
+		sidecars = self.sidecars(path)
+		names = [ts.strftime(DB.FILENAME_FMT) for ts in self.snapshots(path)]
+		jobs = [(os.path.join(path, n), sums.get(n), [(os.path.join(path, f), size, d) for f, size, d in sidecars.get(n, [])]) for n in names]
+		if workers == 1 or len(jobs) < 2:
+			return list(map(verify_file, jobs))
+		from concurrent.futures import ProcessPoolExecutor # slow to import and only needed here
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			return list(pool.map(verify_file, jobs, chunksize=max(1, len(jobs)//64)))
+	
+	@classmethod
+	@contextmanager
+	def lock(self, path):
+		""" Hold the advisory lock of the DB directory \a path.  Other processes wait for it. """
+		if not os.path.isdir(path):
+			print("Creating DB Directory (%s)"%path)
+			os.makedirs(path, exist_ok=True)
+		with open(os.path.join(path, DB.LOCK), 'a+b') as f:
+			with Instrument.timer('DB.lock'):
+				if fcntl:
+					fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+				else:
+					f.seek(0)
+					while True:
+						try:
+							msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+							break
+						except OSError:
+							pass # LK_LOCK gives up after 10 seconds.  Keep waiting.
+			try:
+				yield
+			finally:
+				if fcntl:
+					fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+				else:
+					f.seek(0)
+					msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+	
+	@classmethod
+	def save(self, obj, path, base=None, merge=None):
+		"""
+		Save \a obj as a new snapshot in \a path and return its file name.
 		
+		\a base is the snapshot \a obj was loaded from (the name DB.load returned).  If someone
+		else saved since then, \a merge(base_obj, their_obj, obj) is called to make the object
+		to save instead, or ConflictError is raised if there is no \a merge.
+		"""
+		with self.lock(path):
+			self.check(path) # first make sure the DB is in a consistant state
+			newest = self.snapshots(path)
+			newest = newest[0].strftime(DB.FILENAME_FMT) if newest else None
+			if base and newest and os.path.basename(base) != newest:
+				if not merge:
+					raise ConflictError("%s was saved (%s) after %s was loaded"%(path, newest, os.path.basename(base)))
+				print("%s was saved since %s was loaded.  Merging..."%(newest, os.path.basename(base)))
+				base_obj = self.load(path, datetime.strptime(os.path.basename(base), DB.FILENAME_FMT))[0]
+				their_obj = self.load(path)[0]
+				obj = merge(base_obj, their_obj, obj)
+			return self._save(obj, path)
+	
 	@classmethod
-	def save(self, obj,  path):
-		self.check(path) # first make sure the DB is in a consistant state
+	def _save(self, obj, path):
 		name = datetime.utcnow().strftime(DB.FILENAME_FMT) # get Timestamp 
-		if os.path.exists(os.path.join(path, name)): # Not sure why this might happen
-			raise Exception("This file already exists!  Try again later.")
+		while os.path.exists(os.path.join(path, name)): # Saved twice in one second
+			time.sleep(0.1)
+			name = datetime.utcnow().strftime(DB.FILENAME_FMT)
 		print("Saving DB %s in %s"%(path, name))
 		# Write a 'saving' file while we write the real data.   Delete it when the write is successful
 		with open(os.path.join(path, 'saving'), 'w', encoding='utf-8') as f:
 			f.write(name)
 			f.flush()
-			os.fsync(f.fileno())
-		# Write the real data
+			with Instrument.timer('fsync'):
+				os.fsync(f.fileno())
 		filename = os.path.join(path, name)
-		with open(filename, 'w', encoding='utf-8') as f:
-			yaml.dump(obj, f, width=80, indent=4)
+		sidecars = []
+		try:
+			# Let the object write any side-car files that the snapshot will refer to.
+			# It returns [(file relative to path, size or None for all of it), ...] of every one the snapshot uses.
+			if hasattr(obj, 'db_save'):
+				with Instrument.timer('db_save'):
+					sidecars = obj.db_save(path, name) or []
+			# Write the real data to a temporary file so readers never see half a snapshot
+			with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+				with Instrument.timer('yaml.dump'):
+					yaml.dump(obj, f, width=80, indent=4)
+				f.flush()
+				with Instrument.timer('fsync'):
+					os.fsync(f.fileno())
+			os.replace(filename + '.tmp', filename)
+		except:
+			# No snapshot was written.  db_abort() takes back the side-car data db_save() wrote
+			# (appended ledger records, new files), so nothing is left that no snapshot uses.
+			if hasattr(obj, 'db_abort'):
+				obj.db_abort(path, name)
+			for leftover in [filename + '.tmp', os.path.join(path, 'saving')]:
+				if os.path.exists(leftover):
+					os.remove(leftover)
+			raise
+		Instrument.count('bytes.saved', os.path.getsize(filename))
+		Instrument.count_objects(obj, 'saved')
+		# Record the checksum of what actually reached the disk.  Side-car files (and the part of
+		# them a snapshot uses) never change, so the ones recorded before aren't read again.
+		with Instrument.timer('checksum'):
+			digest = file_digest(filename)
+			if sidecars:
+				known = {(f, size): d for snap in self.sidecars(path).values() for f, size, d in snap}
+				lines = []
+				for sidecar, size in sidecars:
+					if size is None:
+						size = os.path.getsize(os.path.join(path, sidecar))
+					d = known.get((sidecar, size)) or file_digest(os.path.join(path, sidecar), size=size)
+					lines.append("%s  %s  %d  %s\n"%(d, name, size, sidecar))
+				with open(os.path.join(path, DB.SIDECARS), 'a', encoding='utf-8') as f:
+					f.writelines(lines)
+					f.flush()
+					os.fsync(f.fileno())
+		with open(os.path.join(path, DB.CHECKSUMS), 'a', encoding='utf-8') as f:
+			f.write("%s  %s\n"%(digest, name))
 			f.flush()
-			os.fsync(f.fileno())
+			with Instrument.timer('fsync'):
+				os.fsync(f.fileno())
 		# Delete the 'saving' file
 		os.remove(os.path.join(path, 'saving'))
 		print("Save Successful")
@@ -163,6 +509,12 @@ class DB(object):
 		
 	@classmethod
 	def check(self, path):
+		""" Clean up after a save that didn't finish.  Call it with the DB locked (see lock()). """
+		with Instrument.timer('DB.check'):
+			self._check(path)
+	
+	@classmethod
+	def _check(self, path):
 		if not os.path.exists(path):
 			print("Creating DB Directory (%s)"%path)
 			os.makedirs(path)
@@ -172,8 +524,9 @@ class DB(object):
 		if os.path.exists(saving):
 			with open(saving, encoding="utf-8") as f:
 				corrupt = f.read().strip()
-			print("%s file is corrupt... deleting it...")
-			os.remove(os.path.join(path,corrupt))
+			print("%s file is corrupt... deleting it..."%corrupt)
+			for name in [corrupt, corrupt + '.tmp']:
+				if corrupt and os.path.exists(os.path.join(path, name)):
+					os.remove(os.path.join(path, name))
 			os.remove(saving)
 		print("DB OK.")
-
@@ -0,0 +1,134 @@
+"""
+Sum up Transfers.  Pick the transfers with a tag expression (see Tag) and a time range,
+then group them by month, tag, repo or unit and add up from_amt, to_amt and the
+friction (to_amt - from_amt).  Amounts of different units are never added together:
+either the unit is part of every group or the amounts are converted to one unit first.
+
+The transfers are first projected into columns (TransferColumns): times and amounts
+in arrays and everything else as small integer ids into tables.  Transfers usually
+share a handful of tag sets, so a tag expression is matched once per distinct tag
+set instead of once per transfer.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import product
+from PlainTxtDB import Tag, TagSet
+from Ledger import to_epoch
+
+
+class TransferColumns(object):
+	""" A read-only columnar copy of a list of Transfers, sorted by time """
+	GROUPS = ['month', 'tag', 'from_repo', 'to_repo', 'unit']
+	SUMS = ['count', 'from_amt', 'to_amt', 'friction']
+
+	def __init__(self, transfers):
+		transfers = sorted(transfers, key=lambda t: t.timestamp)
+		self.times = array('d')
+		self.from_amt = array('q')
+		self.to_amt = array('q')
+		self.ids = {g: array('i') for g in ['month', 'tagset', 'from_repo', 'to_repo', 'from_unit', 'to_unit']}
+		self.tables = {g: [] for g in self.ids} # id -> value
+		lookup = {g: {} for g in self.ids} # key -> id
+		self.units = {} # unit name -> ValueUnit
+		def intern(g, key, value):
+			if key not in lookup[g]:
+				lookup[g][key] = len(self.tables[g])
+				self.tables[g].append(value())
+			return lookup[g][key]
+		for t in transfers:
+			ts = t.timestamp
+			self.times.append(to_epoch(ts))
+			self.from_amt.append(t.from_amt)
+			self.to_amt.append(t.to_amt)
+			# A transfer with no repo on one side (income, spending) is in the unit of the other side
+			from_unit = (t.from_repo or t.to_repo).unit if t.from_repo or t.to_repo else None
+			to_unit = (t.to_repo or t.from_repo).unit if t.from_repo or t.to_repo else None
+			for unit in (from_unit, to_unit):
+				if unit is not None:
+					self.units.setdefault(str(unit), unit)
+			self.ids['month'].append(intern('month', (ts.year, ts.month), lambda: '%04d-%02d'%(ts.year, ts.month)))
+			self.ids['tagset'].append(intern('tagset', tuple(t.tags), lambda: TagSet(t.tags)))
+			self.ids['from_repo'].append(intern('from_repo', id(t.from_repo), lambda: t.from_repo.name if t.from_repo else None))
+			self.ids['to_repo'].append(intern('to_repo', id(t.to_repo), lambda: t.to_repo.name if t.to_repo else None))
+			self.ids['from_unit'].append(intern('from_unit', str(from_unit), lambda: str(from_unit) if from_unit else None))
+			self.ids['to_unit'].append(intern('to_unit', str(to_unit), lambda: str(to_unit) if to_unit else None))
+
+	def __len__(self):
+		return len(self.times)
+
+	def select(self, tagexpr='', start=None, end=None):
+		""" The row numbers of the transfers matching \a tagexpr between \a start and \a end (inclusive) """
+		if isinstance(tagexpr, str):
+			tagexpr = Tag.parse(tagexpr)
+		lo = bisect_left(self.times, to_epoch(start)) if start else 0
+		hi = bisect_right(self.times, to_epoch(end)) if end else len(self.times)
+		if not tagexpr:
+			return range(lo, hi)
+		matches = [Tag.match(tags, tagexpr) for tags in self.tables['tagset']]
+		tagset = self.ids['tagset']
+		return [i for i in range(lo, hi) if matches[tagset[i]]]
+
+	def aggregate(self, by='month', tagexpr='', start=None, end=None, ratios=None):
+		"""
+		Group the selected transfers by \a by (one of GROUPS or a tuple of them) and
+		return {key: {'count', 'from_amt', 'to_amt', 'friction'}} sorted by key.
+		A transfer with several tags is counted in the group of each tag;  untagged transfers
+		are grouped under None.
+		
+		Without \a ratios the amounts stay in their own units:  the unit name is the last part
+		of every key (unless grouping by 'unit' already put it there) and a transfer between two
+		units counts its from_amt in the group of one and its to_amt in the group of the other.
+		With \a ratios(unit, times), which gives the value of one integral amount of the ValueUnit
+		\a unit at each of the sorted epoch second \a times, the amounts are converted before they
+		are added (nan where there is no market value yet).
+		"""
+		groups = (by,) if isinstance(by, str) else tuple(by)
+		for g in groups:
+			if g not in TransferColumns.GROUPS:
+				raise Exception("Can't group by '%s'.  Try one of %s"%(g, ', '.join(TransferColumns.GROUPS)))
+		split = not ratios or 'unit' in groups # keep the units apart
+		keygroups = groups + (('unit',) if not ratios and 'unit' not in groups else ())
+		# the possible keys of each id, per group ('unit' is filled in per side of the transfer)
+		keys = []
+		for g in keygroups:
+			if g == 'tag':
+				keys.append(('tagset', [sorted(s) or [None] for s in self.tables['tagset']]))
+			elif g != 'unit':
+				keys.append((g, [[v] for v in self.tables[g]]))
+		rows = self.select(tagexpr, start, end)
+		factors = {} # unit id -> the conversion factor of each selected row
+		if ratios:
+			times = [self.times[i] for i in rows]
+			for table in ('from_unit', 'to_unit'):
+				for name in self.tables[table]:
+					if name not in factors:
+						factors[name] = ratios(self.units[name], times) if name else [0.0] * len(times)
+		totals = {}
+		for n, i in enumerate(rows):
+			from_unit = self.tables['from_unit'][self.ids['from_unit'][i]]
+			to_unit = self.tables['to_unit'][self.ids['to_unit'][i]]
+			from_amt, to_amt = self.from_amt[i], self.to_amt[i]
+			if ratios:
+				from_amt *= factors[from_unit][n]
+				to_amt *= factors[to_unit][n]
+			if not split:
+				sides = [(None, from_amt, to_amt)]
+			elif from_unit == to_unit:
+				sides = [(from_unit, from_amt, to_amt)]
+			else:
+				sides = [(from_unit, from_amt, 0), (to_unit, 0, to_amt)]
+			parts = [table[self.ids[col][i]] for col, table in keys]
+			for unit, from_amt, to_amt in sides:
+				it = iter(parts)
+				for key in product(*[[unit] if g == 'unit' else next(it) for g in keygroups]):
+					if key not in totals:
+						totals[key] = [0, 0, 0]
+					sums = totals[key]
+					sums[0] += 1
+					sums[1] += from_amt
+					sums[2] += to_amt
+		out = {}
+		for key in sorted(totals, key=lambda k: [(v is not None, v) for v in k]):
+			count, from_amt, to_amt = totals[key]
+			out[key[0] if len(key) == 1 else key] = {'count': count, 'from_amt': from_amt, 'to_amt': to_amt, 'friction': to_amt - from_amt}
+		return out
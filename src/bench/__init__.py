@@ -0,0 +1,13 @@
+"""
+Benchmarks for the food and money databases.
+
+generate.py makes seeded synthetic data (foods, market histories and ledgers) and
+run.py times the interesting operations on it and keeps a JSON history of the results
+(db/cache/bench_history.json, outside of git) so that a regression can be spotted by
+comparing runs from different commits.
+
+Run it from the src directory:
+
+	python3 -m bench.run
+	python3 -m bench.run --foods 1000,100000 --points 1000000 --transfers 100000
+"""
@@ -0,0 +1,86 @@
+"""
+Seeded synthetic data.  The same seed always gives the same data.
+"""
+import random
+from datetime import datetime, timedelta
+from Food import Food, Ingredient
+from Money import ValueUnit, Market, Repo, Transfer, FinanceSystem, to_epoch
+
+START = datetime(2010, 1, 1)
+
+
+def tag_names(n=200):
+	return ['TAG%03d'%i for i in range(n)]
+
+
+def foods(n, seed=0, depth=6, recipe_fraction=0.3, ntags=200):
+	"""
+	Return a list of \a n Foods.  About \a recipe_fraction of them are recipes, built in
+	\a depth levels where each level only uses foods from the levels below it, so recipes
+	nest up to \a depth deep.  Tags follow a Zipf-like distribution over \a ntags names.
+	"""
+	rnd = random.Random(seed)
+	tags = tag_names(ntags)
+	weights = [1.0/(i+1) for i in range(ntags)]
+	units = [u for u in Ingredient.UNITS] + ['']
+	nbasic = max(1, int(n * (1 - recipe_fraction)))
+	out = []
+	for i in range(n):
+		f = Food(
+			name='food%07d'%i,
+			unit_mass=round(rnd.uniform(1, 500), 2),
+			unit_volume=round(rnd.uniform(1, 500), 2),
+			unit_label=rnd.choice(['', '', 'stick', 'piece', 'can']),
+			kcals=round(rnd.uniform(0, 9), 3) if rnd.random() < 0.8 else -1,
+			protein=round(rnd.uniform(0, 1), 3) if rnd.random() < 0.6 else -1,
+			carbs=round(rnd.uniform(0, 1), 3) if rnd.random() < 0.6 else -1,
+			tags=[],
+			description=rnd.choice(['', 'Synthetic food number %d'%i]),
+			ingredients=[],
+			instructions=[])
+		for t in set(rnd.choices(tags, weights, k=rnd.randint(0, 4))):
+			f.add_tag(t)
+		if i >= nbasic:
+			# levels of recipes:  level k uses foods made before level k started
+			level = 1 + (i - nbasic) * depth // max(1, n - nbasic)
+			pool = nbasic + (level - 1) * (n - nbasic) // depth
+			for j in range(rnd.randint(2, 8)):
+				ing = out[rnd.randrange(pool)]
+				unit = rnd.choice(units)
+				if unit == '':
+					unit = ing.unit_label
+				f.add_ingredient(ing, '%d %s'%(rnd.randint(1, 10), unit), rnd.choice(['', 'sliced', 'diced']))
+			f.instructions = ['Step %d'%k for k in range(rnd.randint(1, 5))]
+		out.append(f)
+	return out
+
+
+def market(npoints, seed=0, step=60):
+	""" A USD/JPY Market with \a npoints assessments \a step seconds apart (a random walk) """
+	rnd = random.Random(seed)
+	m = Market(unitA=ValueUnit(short='USD', frac_digits=2), unitB=ValueUnit(short='JPY'))
+	t0 = int(to_epoch(START))
+	price = 100.0
+	amtB = []
+	for i in range(npoints):
+		price *= 1 + rnd.gauss(0, 0.001)
+		amtB.append(price)
+	m.history().extend(range(t0, t0 + npoints*step, step), [1.0]*npoints, amtB)
+	return m
+
+
+def ledger(ntransfers, nrepos=20, seed=0, ntags=30):
+	""" A FinanceSystem of USD repos with \a ntransfers random transfers over ten years """
+	rnd = random.Random(seed)
+	usd = ValueUnit(short='USD', frac_digits=2)
+	repos = [Repo(name='repo%02d'%i, unit=usd, amt=rnd.randint(0, 10**7), mine=i < nrepos//2) for i in range(nrepos)]
+	tags = tag_names(ntags)
+	span = 10*365*24*3600
+	transfers = []
+	for i in range(ntransfers):
+		a, b = rnd.sample(repos, 2)
+		amt = rnd.randint(1, 100000)
+		transfers.append(Transfer(from_repo=a, to_repo=b, from_amt=amt, to_amt=amt - rnd.randint(0, 100),
+			timestamp=START + timedelta(seconds=rnd.randrange(span)), memo='transfer %d'%i,
+			tags=rnd.sample(tags, rnd.randint(0, 3))))
+	return FinanceSystem(units=[usd], repos=repos, transactions=transfers)
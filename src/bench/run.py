@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+"""
+Time the food and money code on synthetic data and add the results to a JSON history.
+
+	python3 -m bench.run [--foods 1000,10000] [--points 100000] [--transfers 10000]
+	                     [--memory 10000] [--seed 0] [--history db/cache/bench_history.json] [--no-cli]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from PlainTxtDB import DB, Tag
+from Money import to_epoch
+from FoodIndex import FoodIndex
+from FoodTable import FoodTable
+from bench import generate
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY = os.path.join(SRC, 'db', DB.CACHE_DIR, 'bench_history.json') # ignored by git, like the DB caches
+WHERE = 'kcals < 3 & protein > 0.1'
+TAG_EXPRS = ['TAG000', 'TAG001 & -TAG002', '(TAG003, TAG004, -(TAG005, TAG006)) & RECIPE']
+
+
+def timeit(fn, repeat=3):
+	""" The best wall time of \a repeat calls of \a fn.  Printing is silenced. """
+	best = None
+	for i in range(repeat):
+		with contextlib.redirect_stdout(io.StringIO()):
+			t = time.perf_counter()
+			fn()
+			t = time.perf_counter() - t
+		best = t if best is None else min(best, t)
+	return best
+
+
+def bench_foods(n, seed, results, cli=True):
+	foods = generate.foods(n, seed)
+	tmp = tempfile.mkdtemp(prefix='bench_food_')
+	table = tempfile.mkdtemp(prefix='bench_table_')
+	try:
+		results['food/%d/DB.save'%n] = timeit(lambda: (shutil.rmtree(tmp), DB.save(foods, tmp)), repeat=1)
+		results['food/%d/DB.load'%n] = timeit(lambda: DB.load(tmp), repeat=1)
+		results['food/%d/DB.save table'%n] = timeit(lambda: (shutil.rmtree(table), DB.save(FoodTable(foods), table)), repeat=1)
+		results['food/%d/DB.load table'%n] = timeit(lambda: DB.load(table), repeat=1)
+		results['food/%d/load_partial'%n] = timeit(lambda: FoodTable.load_partial(table, [foods[-1].name]))
+		results['food/%d/Tag.parse'%n] = timeit(lambda: [Tag.parse(e) for e in TAG_EXPRS * 1000])
+		exprs = [Tag.parse(e) for e in TAG_EXPRS]
+		results['food/%d/Tag.filter'%n] = timeit(lambda: [Tag.filter(foods, e) for e in exprs])
+		results['food/%d/FoodIndex build'%n] = timeit(lambda: FoodIndex(foods), repeat=1)
+		index = FoodIndex(foods)
+		where = FoodIndex.parse(WHERE)
+		results['food/%d/FoodIndex select'%n] = timeit(lambda: [index.select(e, where) for e in exprs])
+		results['food/%d/FoodIndex page top 20'%n] = timeit(lambda: list(FoodIndex.page(foods, '-kcals', 20)))
+		ingredients = [i for f in foods for i in f.ingredients]
+		results['food/%d/Ingredient.amt'%n] = timeit(lambda: [i.amt(u) for i in ingredients for u in ('g', 'cup', i.food.unit_label)])
+		if cli:
+			def run(*args):
+				subprocess.run([sys.executable, os.path.join(SRC, 'FoodCMD.py'), 'load', tmp] + list(args),
+					cwd=SRC, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+			results['food/%d/cli list'%n] = timeit(lambda: run('list', 'TAG000'), repeat=1)
+			results['food/%d/cli list where'%n] = timeit(lambda: run('list', 'TAG000', 'where=' + WHERE), repeat=1)
+			results['food/%d/cli show'%n] = timeit(lambda: run('food', foods[-1].name, 'show'), repeat=1)
+	finally:
+		shutil.rmtree(tmp, ignore_errors=True)
+		shutil.rmtree(table, ignore_errors=True)
+
+
+def bench_startup(results):
+	""" Wall time of a FoodCMD.py call that doesn't load the DB, and its import time from --profile """
+	cmd = [sys.executable, os.path.join(SRC, 'FoodCMD.py')]
+	results['cli/startup help'] = timeit(lambda: subprocess.run(cmd + ['help'], cwd=SRC, stdout=subprocess.DEVNULL, check=True), repeat=5)
+	out = subprocess.run(cmd + ['--profile', 'help'], cwd=SRC, capture_output=True, text=True, check=True)
+	results['cli/startup imports'] = json.loads(out.stderr)['timers']['startup.imports']['seconds']
+
+
+def bench_memory(n, seed, results):
+	""" Bytes per loaded Food (with its ingredients and tags) and per Transfer """
+	def measure(make, count):
+		tracemalloc.start()
+		with contextlib.redirect_stdout(io.StringIO()):
+			obj = make()
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		return size / count
+	foods = generate.foods(n, seed)
+	tmp = tempfile.mkdtemp(prefix='bench_mem_')
+	try:
+		DB.save(foods, tmp)
+		results['mem/food/%d/bytes per food'%n] = measure(lambda: DB.load(tmp), n)
+	finally:
+		shutil.rmtree(tmp, ignore_errors=True)
+	results['mem/ledger/%d/bytes per transfer'%n] = measure(lambda: generate.ledger(n, seed=seed).transactions, n)
+
+
+def bench_market(npoints, seed, results):
+	m = generate.market(npoints, seed)
+	rnd = random.Random(seed)
+	times = [generate.START + timedelta(seconds=rnd.randrange(npoints*60)) for i in range(10000)]
+	results['market/%d/get_ratio'%npoints] = timeit(lambda: [m.get_ratio(t) for t in times])
+	secs = sorted(to_epoch(t) for t in times)
+	results['market/%d/get_ratios'%npoints] = timeit(lambda: m.get_ratios(secs))
+
+
+def bench_ledger(ntransfers, seed, results):
+	system = generate.ledger(ntransfers, seed=seed)
+	rnd = random.Random(seed)
+	days = [generate.START + timedelta(days=d) for d in range(0, 3650, 7)]
+	results['ledger/%d/Ledger build'%ntransfers] = timeit(lambda: setattr(system, '_ledger', None) or system.ledger(), repeat=1)
+	results['ledger/%d/balance'%ntransfers] = timeit(lambda: [system.balance(rnd.choice(system.repos), rnd.choice(days)) for i in range(1000)])
+	results['ledger/%d/net_worth weekly'%ntransfers] = timeit(lambda: system.net_worth('USD', days))
+	results['ledger/%d/report build'%ntransfers] = timeit(lambda: setattr(system, '_columns', None) or system.columns(), repeat=1)
+	results['ledger/%d/report month'%ntransfers] = timeit(lambda: system.report('month', 'TAG000 & -TAG001'))
+
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC, capture_output=True, text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+
+def compare(results, history):
+	""" Print the results next to the latest earlier run of each benchmark """
+	for name in sorted(results):
+		old = next((run['results'][name] for run in reversed(history) if name in run['results']), None)
+		change = " (%+.0f%%)"%(100.0*(results[name] - old)/old) if old else ''
+		if name.startswith('mem/'):
+			print("%-40s %10.0f B%s"%(name, results[name], change))
+		else:
+			print("%-40s %10.4f s%s"%(name, results[name], change))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--foods', default='1000,10000', help="comma separated food DB sizes")
+	parser.add_argument('--points', default='100000', help="comma separated market history sizes")
+	parser.add_argument('--transfers', default='10000', help="comma separated ledger sizes")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--history', default=HISTORY, help="the JSON file of earlier results (default: %(default)s)")
+	parser.add_argument('--no-cli', action='store_true', help="don't time the FoodCMD.py commands (or its startup)")
+	parser.add_argument('--memory', default='10000', help="comma separated sizes to measure the memory per object of")
+	args = parser.parse_args(argv)
+
+	sizes = lambda s: [int(x) for x in s.split(',') if x.strip()]
+	results = {}
+	if not args.no_cli:
+		bench_startup(results)
+	for n in sizes(args.foods):
+		bench_foods(n, args.seed, results, not args.no_cli)
+	for n in sizes(args.memory):
+		bench_memory(n, args.seed, results)
+	for n in sizes(args.points):
+		bench_market(n, args.seed, results)
+	for n in sizes(args.transfers):
+		bench_ledger(n, args.seed, results)
+
+	history = []
+	if os.path.exists(args.history):
+		with open(args.history, encoding='utf-8') as f:
+			history = json.load(f)
+	compare(results, history)
+	history.append({
+		'time': datetime.utcnow().isoformat(),
+		'commit': git_commit(),
+		'python': platform.python_version(),
+		'seed': args.seed,
+		'results': results,
+	})
+	os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+	with open(args.history, 'w', encoding='utf-8') as f:
+		json.dump(history, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
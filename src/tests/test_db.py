@@ -0,0 +1,148 @@
+"""
+Tests of the snapshot DB.  Run from src/:  python3 -m pytest tests
+"""
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import yaml
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PlainTxtDB import DB
+from Money import ValueUnit, Market, Repo, Transfer, FinanceSystem
+from Food import Food, Ingredient
+from FoodTable import FoodTable
+import FoodDiff
+
+
+def finances():
+	usd = ValueUnit(short='USD', frac_digits=2)
+	jpy = ValueUnit(short='JPY', frac_digits=0)
+	market = Market(unitA=usd, unitB=jpy)
+	for day in range(10):
+		market.assess({'USD': 1, 'JPY': 100 + day}, datetime(2020, 1, 1) + timedelta(days=day))
+	a = Repo(name='a', unit=usd, amt=1000)
+	b = Repo(name='b', unit=usd, amt=0)
+	transfers = [Transfer(from_repo=a, from_amt=i, to_repo=b, to_amt=i, timestamp=datetime(2020, 1, 1) + timedelta(days=i)) for i in range(1, 50)]
+	return FinanceSystem(units=[usd, jpy], markets=[market], repos=[a, b], transactions=transfers)
+
+
+class VerifyTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix='test_db_')
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def statuses(self):
+		return {os.path.basename(f): status for f, status, message in DB.verify(self.path, workers=1)}
+
+	def corrupt(self, filename):
+		with open(os.path.join(self.path, filename), 'r+b') as f:
+			f.seek(20)
+			byte = f.read(1)
+			f.seek(20)
+			f.write(bytes([byte[0] ^ 0xff]))
+
+	def test_sidecars_are_checked(self):
+		system = finances()
+		first = os.path.basename(DB.save(system, self.path))
+		used = DB.sidecars(self.path)[first]
+		self.assertEqual(sorted(os.path.dirname(f) for f, size, d in used), ['ledger', 'ledger', 'prices'])
+		self.assertEqual(set(self.statuses().values()), {'ok'})
+		self.corrupt(used[0][0])
+		self.assertEqual(self.statuses()[first], 'corrupt')
+
+	def test_fallback_skips_bad_sidecars(self):
+		system = finances()
+		first = os.path.basename(DB.save(system, self.path))
+		a, b = system.repos
+		system.add_transfer(Transfer(from_repo=a, from_amt=1, to_repo=b, to_amt=1, timestamp=datetime(2020, 2, 25)))
+		second = os.path.basename(DB.save(system, self.path))
+		self.assertEqual(self.statuses(), {first: 'ok', second: 'ok'})
+		# Break the end of the newest segment, which only the newer snapshot uses
+		segment = [f for f, size, d in DB.sidecars(self.path)[second] if f.startswith('ledger')][-1]
+		with open(os.path.join(self.path, segment), 'r+b') as f:
+			f.seek(-5, os.SEEK_END)
+			f.write(b'xxxxx')
+		self.assertEqual(self.statuses(), {first: 'ok', second: 'corrupt'})
+		self.assertEqual(os.path.basename(DB.load(self.path, fallback=True)[1]), first)
+
+
+class SnapshotNameTest(unittest.TestCase):
+	def test_names(self):
+		path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db', 'food')
+		newest = DB.snapshots(path)[0].strftime(DB.FILENAME_FMT)
+		self.assertEqual(DB.snapshot(path), newest)
+		self.assertEqual(DB.snapshot(path, -1), newest)
+		self.assertEqual(DB.snapshot(path, '-1'), newest)
+		self.assertEqual(DB.snapshot(path, newest[:4]), newest) # a year, not snapshot number 2017
+		self.assertEqual(DB.snapshot(path, newest[:10]), newest)
+		with self.assertRaises(Exception):
+			DB.snapshot(path, '1999')
+
+
+class FoodTableTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix='test_db_')
+		flour = Food(name='flour', kcals=3.6)
+		sugar = Food(name='sugar', kcals=4.0)
+		cake = Food(name='cake', ingredients=[Ingredient(food=flour, amount=1.0, unit='cup'), Ingredient(food=sugar, amount=0.5, unit='cup')])
+		self.first = DB.save(FoodTable([flour, sugar, cake, Food(name='salt')]), self.path)
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_sidecars_are_checked(self):
+		self.assertEqual(sorted(f for f, size, d in DB.sidecars(self.path)[os.path.basename(self.first)]),
+			['foods/%s.idx'%os.path.basename(self.first)[:-5], 'foods/%s'%os.path.basename(self.first)])
+
+	def test_merge_partial_load(self):
+		ours, base = FoodTable.load_partial(self.path, ['flour'])
+		# Someone else deletes a food and changes another one that we never loaded
+		theirs = DB.load(self.path)[0]
+		theirs.remove([f for f in theirs if f.name == 'salt'][0])
+		[f for f in theirs if f.name == 'sugar'][0].kcals = 3.9
+		DB.save(theirs, self.path)
+		ours[0].kcals = 3.5
+		DB.save(ours, self.path, base=base, merge=FoodDiff.merge)
+		foods = {f.name: f for f in DB.load(self.path)[0]}
+		self.assertEqual(sorted(foods), ['cake', 'flour', 'sugar'])
+		self.assertEqual((foods['flour'].kcals, foods['sugar'].kcals), (3.5, 3.9))
+		self.assertIs(foods['cake'].ingredients[1].food, foods['sugar'])
+
+	def test_partial_save_keeps_order(self):
+		ours = FoodTable.load_partial(self.path, ['cake'])[0]
+		[f for f in ours if f.name == 'sugar'][0].kcals = 3.9
+		ours.append(Food(name='honey'))
+		DB.save(ours, self.path)
+		self.assertEqual([f.name for f in DB.load(self.path)[0]], ['flour', 'sugar', 'cake', 'salt', 'honey'])
+
+	def test_find_unloaded(self):
+		ours = FoodTable.load_partial(self.path, ['flour'])[0]
+		self.assertIsNone(ours.find('pepper'))
+		cake = ours.find('cake')
+		self.assertEqual(sorted(f.name for f in ours), ['cake', 'flour', 'sugar'])
+		self.assertIs(cake.ingredients[0].food, ours[0]) # the flour that was already loaded
+		# A food made without reading the one in the file would replace it
+		ours.append(Food(name='salt'))
+		with self.assertRaises(Exception):
+			DB.save(ours, self.path)
+		self.assertEqual(len(DB.snapshots(self.path)), 1)
+
+
+class SlotsStateTest(unittest.TestCase):
+	def test_tuples_stay_tuples(self):
+		food = Food(name='rice', tags=['GRAIN'], instructions=('rinse', 'boil'))
+		text = yaml.dump(food)
+		self.assertIn('- GRAIN', text) # tags are written as a plain list
+		loaded = yaml.load(text, Loader=yaml.Loader)
+		self.assertEqual(loaded.tags, ('GRAIN',))
+		self.assertEqual(loaded.instructions, ('rinse', 'boil'))
+
+
+if __name__ == '__main__':
+	unittest.main()
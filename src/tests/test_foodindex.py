@@ -0,0 +1,110 @@
+"""
+Tests of FoodIndex against a plain scan.  Run from src/:  python3 -m pytest tests
+"""
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PlainTxtDB import Tag
+from Food import Food
+from FoodIndex import FoodIndex
+from bench.generate import foods
+
+
+OPS = {'<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b, '=': lambda a, b: a == b}
+
+
+def scan(foods, tagexpr, where):
+	""" What FoodIndex.select() should find, the slow way """
+	return [f for f in Tag.filter(foods, tagexpr) if all(
+		getattr(f, field) != FoodIndex.UNKNOWN and OPS[op](getattr(f, field), value) for field, op, value in where)]
+
+
+class RangeTest(unittest.TestCase):
+	def setUp(self):
+		self.index = FoodIndex([Food(name=n, kcals=k) for n, k in [('a', 2), ('b', 1), ('c', -1), ('d', 2), ('e', 3)]])
+
+	def names(self, where):
+		return [f.name for f in self.index.select('', FoodIndex.parse(where))]
+
+	def test_bounds(self):
+		self.assertEqual(self.names('kcals < 2'), ['b'])
+		self.assertEqual(self.names('kcals <= 2'), ['a', 'b', 'd'])
+		self.assertEqual(self.names('kcals = 2'), ['a', 'd'])
+		self.assertEqual(self.names('kcals == 2/g'), ['a', 'd'])
+		self.assertEqual(self.names('kcals > 2'), ['e'])
+		self.assertEqual(self.names('kcals >= 2'), ['a', 'd', 'e'])
+
+	def test_unknown_never_matches(self):
+		self.assertEqual(self.names('kcals > -5'), ['a', 'b', 'd', 'e'])
+		self.assertEqual(self.names('kcals = -1'), [])
+		self.assertEqual(self.names('kcals < 10 & kcals > -10'), ['a', 'b', 'd', 'e'])
+
+
+class SelectTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.foods = foods(20000)
+		cls.index = FoodIndex(cls.foods)
+
+	def test_against_scan(self):
+		for tagexpr, where in [
+				('TAG000', ''),
+				('TAG000 & -TAG001', 'kcals < 3'),
+				('TAG002, TAG003', 'protein >= 0.5 & carbs < 0.2'),
+				('', 'kcals = 4.5'),
+				('', 'unit_mass <= 100 & unit_volume > 400 & kcals > 8'),
+				('-TAG000', 'carbs > 2')]:
+			where = FoodIndex.parse(where)
+			self.assertEqual(self.index.select(tagexpr, where), scan(self.foods, tagexpr, where), (tagexpr, where))
+
+	def test_intersection_order(self):
+		# The smallest set is intersected first, whatever order the predicates come in
+		where = FoodIndex.parse('kcals > 1 & protein < 0.9 & carbs > 0.95')
+		expected = scan(self.foods, 'TAG000', where)
+		self.assertTrue(expected)
+		for order in [where, where[::-1], where[1:] + where[:1]]:
+			self.assertEqual(self.index.select('TAG000', order), expected)
+
+
+def stable_sort(foods, sort):
+	""" What FoodIndex.page() should give:  a full stable sort with the unknown values last """
+	field = sort.lstrip('-')
+	known = [f for f in foods if field == 'name' or getattr(f, field) != FoodIndex.UNKNOWN]
+	unknown = [f for f in foods if field != 'name' and getattr(f, field) == FoodIndex.UNKNOWN]
+	return sorted(known, key=lambda f: getattr(f, field), reverse=sort.startswith('-')) + unknown
+
+
+class PageTest(unittest.TestCase):
+	def names(self, foods, sort, limit=None, offset=0):
+		return [f.name for f in FoodIndex.page(foods, sort, limit, offset)]
+
+	def test_unknown_last(self):
+		small = [Food(name=n, kcals=k) for n, k in [('a', 2), ('b', -1), ('c', 3), ('d', 2), ('e', -1), ('f', 1)]]
+		self.assertEqual(self.names(small, 'kcals'), ['f', 'a', 'd', 'c', 'b', 'e'])
+		self.assertEqual(self.names(small, '-kcals'), ['c', 'a', 'd', 'f', 'b', 'e'])
+		# Ties keep their order across a page boundary
+		self.assertEqual(self.names(small, '-kcals', 2, 0) + self.names(small, '-kcals', 2, 2), ['c', 'a', 'd', 'f'])
+		self.assertEqual(self.names(small, '', 2, 4), ['e', 'f'])
+
+	def test_pages_against_full_sort(self):
+		foods5000 = foods(5000)
+		for f in foods5000[::3]:
+			if f.kcals != FoodIndex.UNKNOWN:
+				f.kcals = round(f.kcals) # plenty of ties
+		for sort in ['kcals', '-kcals', '-protein', 'name', '-name']:
+			expected = [f.name for f in stable_sort(foods5000, sort)]
+			self.assertEqual(self.names(foods5000, sort), expected, sort)
+			pages = []
+			for offset in range(0, len(foods5000), 250):
+				pages += self.names(foods5000, sort, 250, offset)
+			self.assertEqual(pages, expected, sort)
+
+	def test_bad_field(self):
+		with self.assertRaises(Exception):
+			FoodIndex.page([], 'bogus')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,284 @@
+"""
+Tests of the finance code.  Run from src/:  python3 -m pytest tests
+"""
+import math
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PlainTxtDB import DB
+from Money import ValueUnit, Market, Repo, Transfer, FinanceSystem, to_epoch
+from BankImport import StatementImporter, ImportRule
+
+
+def markets():
+	""" BTC -> USD -> JPY where the BTC market starts at 10:30 """
+	usd = ValueUnit(short='USD', frac_digits=2)
+	jpy = ValueUnit(short='JPY', frac_digits=0)
+	btc = ValueUnit(short='BTC', frac_digits=8)
+	usdjpy = Market(unitA=usd, unitB=jpy)
+	usdjpy.assess({'USD': 1, 'JPY': 100}, datetime(2020, 1, 1, 0, 0))
+	usdjpy.assess({'USD': 1, 'JPY': 120}, datetime(2020, 1, 2, 0, 0))
+	btcusd = Market(unitA=btc, unitB=usd)
+	btcusd.assess({'BTC': 1, 'USD': 7000}, datetime(2020, 1, 1, 10, 30))
+	btcusd.assess({'BTC': 1, 'USD': 8000}, datetime(2020, 1, 1, 11, 30))
+	return FinanceSystem(units=[usd, jpy, btc], markets=[usdjpy, btcusd])
+
+
+START = datetime(2020, 1, 1)
+
+
+def ledger(n=600):
+	""" Two USD repos and \a n transfers of 1..n cents from one to the other, an hour apart """
+	usd = ValueUnit(short='USD', frac_digits=2)
+	a = Repo(name='a', unit=usd, amt=10**6)
+	b = Repo(name='b', unit=usd, amt=0)
+	transfers = [Transfer(from_repo=a, from_amt=i, to_repo=b, to_amt=i, timestamp=START + timedelta(hours=i), tags=['T'])
+		for i in range(1, n+1)]
+	return FinanceSystem(units=[usd], repos=[a, b], transactions=transfers)
+
+
+def replay(system, repo, when):
+	""" The balance the slow way """
+	return repo.amt + sum(t.to_amt for t in system.transactions if t.to_repo is repo and t.timestamp <= when) \
+		- sum(t.from_amt for t in system.transactions if t.from_repo is repo and t.timestamp <= when)
+
+
+class ConversionTest(unittest.TestCase):
+	def test_ratio_at_the_exact_time(self):
+		system = markets()
+		when = datetime(2020, 1, 1, 10, 45) # after the first BTC assessment, in the same hour
+		expected = 7250 * (100 + 20 * (10.75 / 24))
+		self.assertAlmostEqual(system.conversion_ratio('BTC', 'JPY', when), expected)
+		self.assertAlmostEqual(system.conversion_ratios('BTC', 'JPY', [to_epoch(when)])[0], expected)
+
+	def test_ratio_before_the_first_assessment(self):
+		system = markets()
+		when = datetime(2020, 1, 1, 10, 15)
+		with self.assertRaises(Exception):
+			system.conversion_ratio('BTC', 'JPY', when)
+		self.assertTrue(math.isnan(system.conversion_ratios('BTC', 'JPY', [to_epoch(when)])[0]))
+
+	def test_cache_follows_new_assessments(self):
+		system = markets()
+		when = datetime(2020, 1, 1, 11, 0)
+		before = system.conversion_ratio('BTC', 'USD', when)
+		system.markets[1].assess({'BTC': 1, 'USD': 9000}, datetime(2020, 1, 1, 10, 50))
+		self.assertNotEqual(system.conversion_ratio('BTC', 'USD', when), before)
+
+	def test_valuation_of_an_unpriced_unit(self):
+		system = markets()
+		usd, jpy, btc = system.units
+		land = ValueUnit(short='LAND', frac_digits=0)
+		system.units.append(land)
+		system.repos = [Repo(name='cash', unit=usd, amt=500), Repo(name='farm', unit=land, amt=1), Repo(name='wallet', unit=btc, amt=10**8)]
+		times = [datetime(2020, 1, 1, 10, 0), datetime(2020, 1, 2)]
+		repos, rows = system.valuation('JPY', times)
+		self.assertAlmostEqual(rows[0][1], 5 * 120) # 500 cents
+		self.assertTrue(all(math.isnan(v) for v in rows[1]))
+		self.assertTrue(math.isnan(rows[2][0])) # before the first BTC price
+		self.assertAlmostEqual(rows[2][1], 8000 * 120)
+		self.assertTrue(all(math.isnan(v) for v in system.net_worth('JPY', times)))
+
+
+class LedgerTest(unittest.TestCase):
+	def check(self, system):
+		a, b = system.repos
+		for hours in [0, 1, 100, 255, 256, 257, 400, 599, 600, 700]:
+			when = START + timedelta(hours=hours)
+			self.assertEqual(system.balance(b, when), replay(system, b, when))
+			self.assertEqual(system.balance(a, when), replay(system, a, when))
+
+	def test_back_dated_and_removed(self):
+		system = ledger()
+		a, b = system.repos
+		self.check(system)
+		# Same length as before so only the edits can tell the ledger is stale
+		system.transactions.append(Transfer(from_repo=a, from_amt=5000, to_repo=b, to_amt=5000, timestamp=START + timedelta(hours=3, minutes=30)))
+		del system.transactions[10]
+		self.assertEqual(len(system.transactions), 600)
+		self.check(system)
+
+	def test_add_and_remove_transfer(self):
+		system = ledger()
+		a, b = system.repos
+		self.check(system)
+		t = Transfer(from_repo=a, from_amt=7, to_repo=b, to_amt=7, timestamp=START + timedelta(hours=2, minutes=1))
+		system.add_transfer(t)
+		self.check(system)
+		system.remove_transfer(system.transactions[300])
+		self.check(system)
+		system.remove_transfer(t)
+		self.check(system)
+
+	def test_report_columns(self):
+		system = ledger(10)
+		self.assertEqual(system.report('tag')[('T', 'USD')]['count'], 10)
+		system.transactions[0] = Transfer(from_repo=system.repos[0], from_amt=1, to_repo=system.repos[1], to_amt=1, timestamp=START)
+		system.transactions[0].tags = ('U',)
+		self.assertEqual(system.report('tag')[('T', 'USD')]['count'], 9)
+
+class ReportTest(unittest.TestCase):
+	def system(self):
+		""" Cash in USD that buys BTC twice and spends some USD """
+		system = markets()
+		usd, jpy, btc = system.units
+		cash = Repo(name='cash', unit=usd, amt=10**6)
+		wallet = Repo(name='wallet', unit=btc, amt=0)
+		system.repos = [cash, wallet]
+		btcusd = system.markets[1]
+		system.transactions = [
+			Transfer(from_repo=cash, from_amt=7250_00, to_repo=wallet, to_amt=10**8, market=btcusd, timestamp=datetime(2020, 1, 1, 10, 45), tags=['BUY']),
+			Transfer(from_repo=cash, from_amt=8000_00, to_repo=wallet, to_amt=10**8, market=btcusd, timestamp=datetime(2020, 1, 1, 11, 30), tags=['BUY']),
+			Transfer(from_repo=cash, from_amt=500, to_repo=None, to_amt=0, timestamp=datetime(2020, 1, 1, 12, 0), tags=['FOOD']),
+		]
+		return system
+
+	def test_units_are_not_added(self):
+		report = self.system().report('tag')
+		self.assertEqual(report[('BUY', 'USD')], {'count': 2, 'from_amt': 15250_00, 'to_amt': 0, 'friction': -15250_00})
+		self.assertEqual(report[('BUY', 'BTC')], {'count': 2, 'from_amt': 0, 'to_amt': 2*10**8, 'friction': 2*10**8})
+		self.assertEqual(report[('FOOD', 'USD')]['from_amt'], 500)
+		self.assertEqual(self.system().report('unit')['BTC']['to_amt'], 2*10**8)
+
+	def test_converted(self):
+		report = self.system().report('tag', unit='USD')
+		self.assertAlmostEqual(report['BUY']['from_amt'], 15250.0)
+		self.assertAlmostEqual(report['BUY']['to_amt'], 15250.0)
+		self.assertAlmostEqual(report['BUY']['friction'], 0.0)
+		self.assertAlmostEqual(report['FOOD']['from_amt'], 5.0)
+
+
+class LedgerStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix='test_money_')
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def round_trip(self, system):
+		""" Save \a system, load it back and check it has the same transfers """
+		expected = sorted((t.timestamp, t.from_amt) for t in system.transactions)
+		DB.save(system, self.path)
+		loaded = DB.load(self.path)[0]
+		self.assertEqual(sorted((t.timestamp, t.from_amt) for t in loaded.transactions), expected)
+		return loaded
+
+	def test_appended_to_transactions(self):
+		system = ledger(600)
+		DB.save(system, self.path)
+		a, b = system.repos
+		system.transactions.append(Transfer(from_repo=a, from_amt=3, to_repo=b, to_amt=3, timestamp=START + timedelta(hours=1000)))
+		system.add_transfer(Transfer(from_repo=a, from_amt=4, to_repo=b, to_amt=4, timestamp=START + timedelta(hours=2)))
+		loaded = self.round_trip(system)
+		self.assertEqual(len(loaded.transactions), 602)
+		# And again from the loaded system, which appends to the partitions it came from
+		loaded.transactions.append(Transfer(from_repo=loaded.repos[0], from_amt=5, to_repo=loaded.repos[1], to_amt=5, timestamp=START + timedelta(hours=1001)))
+		self.assertEqual(len(self.round_trip(loaded).transactions), 603)
+
+	def test_add_transfer_before_reading(self):
+		DB.save(ledger(10), self.path)
+		system = DB.load(self.path)[0]
+		a, b = system.repos
+		system.add_transfer(Transfer(from_repo=a, from_amt=3, to_repo=b, to_amt=3, timestamp=START))
+		DB.save(system, self.path)
+		self.assertEqual(len(DB.load(self.path)[0].transactions), 11)
+
+	def test_edited_transactions(self):
+		DB.save(ledger(20), self.path)
+		system = DB.load(self.path)[0]
+		del system.transactions[5]
+		system.transactions[0].from_amt = 99 # changing a transfer isn't seen, replacing it is
+		system.transactions[0] = system.transactions[0]
+		loaded = self.round_trip(system)
+		self.assertEqual(len(loaded.transactions), 19)
+		# The older snapshot still has what it had
+		older = DB.load(self.path, when=DB.snapshots(self.path)[1])[0]
+		self.assertEqual(len(older.transactions), 20)
+
+	def test_failed_save_is_undone(self):
+		DB.save(ledger(10), self.path)
+		system = DB.load(self.path)[0]
+		a, b = system.repos
+		system.transactions.append(Transfer(from_repo=a, from_amt=3, to_repo=b, to_amt=3, timestamp=START + timedelta(days=60)))
+		system.transactions.append(Transfer(from_repo=a, from_amt=4, to_repo=b, to_amt=4, timestamp=START))
+		files = {f: os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(self.path) for f in fs}
+		with mock.patch('PlainTxtDB.yaml.dump', side_effect=OSError('disk full')):
+			with self.assertRaises(OSError):
+				DB.save(system, self.path)
+		self.assertEqual({f: os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(self.path) for f in fs}, files)
+		self.assertEqual(len(DB.snapshots(self.path)), 1)
+		# The records that weren't saved are written by the next save
+		self.assertEqual(len(self.round_trip(system).transactions), 12)
+		self.assertEqual([status for _, status, _ in DB.verify(self.path)], ['ok', 'ok'])
+
+
+class ImportTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix='test_money_')
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def write(self, name, lines):
+		filename = os.path.join(self.path, name)
+		with open(filename, 'w', encoding='utf-8') as f:
+			f.write('\n'.join(lines) + '\n')
+		return filename
+
+	def test_import_csv(self):
+		usd = ValueUnit(short='USD', frac_digits=2)
+		jpy = ValueUnit(short='JPY', frac_digits=0)
+		m = Market(unitA=usd, unitB=jpy)
+		for h, b in [(0, 100), (2, 110), (4, 120)]:
+			m.assess({'USD': 1, 'JPY': b}, START + timedelta(hours=h))
+		hour = lambda h: (START + timedelta(hours=h)).isoformat()
+		# Out of order and 3 rows per chunk, overlapping the history and each other
+		filename = self.write('usdjpy.csv', ['when,USD,JPY'] + ['%s,1,%s'%(hour(h), b) for h, b in [
+			(5, 125), (1, 105), (2, 110), # 2 is already there:  a duplicate
+			(4, 999), (3, 115), (2, 111), # 4 and 2 conflict with the history
+			(1, 106), (6, 130), (6, 130)]] + ['bogus,1,1']) # 1 conflicts with the first chunk, 6 is a duplicate
+		report = m.import_csv(filename, chunk_size=3)
+		self.assertEqual(report['added'], 4)
+		self.assertEqual(sorted(report['duplicates']), [START + timedelta(hours=2), START + timedelta(hours=6)])
+		self.assertEqual(sorted(report['conflicts']), [
+			(START + timedelta(hours=1), (1.0, 105.0), (1.0, 106.0)),
+			(START + timedelta(hours=2), (1.0, 110.0), (1.0, 111.0)),
+			(START + timedelta(hours=4), (1.0, 120.0), (1.0, 999.0))])
+		self.assertEqual([line for line, message in report['errors']], [11])
+		times, amtA, amtB = m.history().columns()
+		self.assertEqual([to_epoch(START + timedelta(hours=h)) for h in range(7)], list(times))
+		self.assertEqual(list(amtB), [100, 105, 110, 115, 120, 125, 130])
+
+	def test_statement_overlap(self):
+		usd = ValueUnit(short='USD', frac_digits=2)
+		jpy = ValueUnit(short='JPY', frac_digits=0)
+		repos = [Repo(name='Checking', unit=usd), Repo(name='External', unit=usd, mine=False), Repo(name='Yen', unit=jpy)]
+		DB.save(FinanceSystem(units=[usd, jpy], repos=repos), self.path)
+		def run(lines, rules=()):
+			system, name = DB.load(self.path)
+			importer = StatementImporter(system, self.path, rules=rules)
+			report = importer.run(self.write('statement.csv', ['Date,Description,Amount'] + lines), 'Checking')
+			DB.save(system, self.path, base=name)
+			importer.index.commit()
+			return report
+		coffee = '2020-01-01,COFFEE,-3.00'
+		report = run([coffee, coffee, '2020-01-02,PAY,"1,000.00"'])
+		self.assertEqual((report['imported'], report['skipped']), (3, 0))
+		# The next statement overlaps:  a third coffee that day is new, the first two aren't
+		report = run([coffee, coffee, coffee, '2020-01-02,PAY,"1,000.00"', '2020-01-03,RENT,-500.00', '2020-01-04,FEE,abc',
+			'2020-01-05,YEN SHOP,-1.00'], rules=[ImportRule('YEN', repo='Yen')])
+		self.assertEqual((report['imported'], report['skipped']), (2, 3))
+		self.assertEqual([message for line, message in report['errors']], ["'abc' is not an amount", "Yen is in JPY, not USD like Checking"])
+		system = DB.load(self.path)[0]
+		self.assertEqual(sorted(t.from_amt for t in system.transactions), [300, 300, 300, 50000, 100000])
+		self.assertEqual(system.balance(system.repos[0], datetime(2020, 2, 1)), 100000 - 900 - 50000)
+
+
+if __name__ == '__main__':
+	unittest.main()